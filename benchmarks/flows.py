@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark of the commit, --branch and --pr flows, fully offline.
+
+Builds synthetic git repositories (with a local bare repository as origin),
+answers API calls from the local stub in stub_openai.py, replaces `gh` with a
+stub script, and runs each flow several times with `--profile-file`. Reports
+percentiles of the harness-measured wall time, of gcpai's own time (wall time
+minus time spent waiting on prompts) and of every profiled stage. Runs are
+headless (`--yes`); with --pty the interactive prompts are answered with Enter
+through a pseudo-terminal instead.
+
+    python benchmarks/flows.py --runs 10 --files 2000 --changed-files 20 --diff-lines 50 --latency-ms 300
+"""
+
+import argparse
+import json
+import math
+import os
+import pty
+import re
+import select
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stub_openai import StubOpenAI
+
+GCPAI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gcpai.py")
+FLOWS = {"commit": [], "branch": ["--branch"], "pr": ["--pr"]}
+GH_STUB = """#!/bin/sh
+[ "$1" = "--version" ] && { echo "gh version 0.0.0 (stub)"; exit 0; }
+echo "https://github.com/example/benchmark/pull/1"
+"""
+GIT_IDENTITY = {"GIT_AUTHOR_NAME": "bench", "GIT_AUTHOR_EMAIL": "bench@example.com",
+                "GIT_COMMITTER_NAME": "bench", "GIT_COMMITTER_EMAIL": "bench@example.com"}
+ANSI = re.compile(rb"\x1b\[[0-9;?]*[a-zA-Z]")
+SELECT_PROMPT = re.compile(rb"Select the type of change[^:]*:")
+REVIEW_PROMPT = b"Accept? (Y)"
+
+def git(repo, *args):
+    subprocess.run(["git", "-C", repo, *args], check=True, stdout=subprocess.DEVNULL,
+                   env={**os.environ, **GIT_IDENTITY})
+
+def make_repo(root, files, file_lines, branch_commits, diff_lines):
+    """Creates `root`/repo with `files` tracked files, pushed to `root`/origin.git, plus a
+    `feature` branch `branch_commits` commits ahead of main for the PR flow."""
+    origin, repo = os.path.join(root, "origin.git"), os.path.join(root, "repo")
+    os.makedirs(root)
+    git(root, "init", "-q", "--bare", "-b", "main", origin)
+    git(root, "init", "-q", "-b", "main", repo)
+    git(repo, "remote", "add", "origin", origin)
+    for i in range(files):
+        path = os.path.join(repo, "src", f"module{i // 100}", f"file{i}.py")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            file.writelines(f"value_{i}_{line} = {line}\n" for line in range(file_lines))
+    git(repo, "add", "-A")
+    git(repo, "commit", "-q", "-m", "initial")
+    git(repo, "push", "-q", "origin", "main")
+    git(repo, "checkout", "-q", "-b", "feature")
+    for commit in range(branch_commits):
+        change_files(repo, files, 1, diff_lines, f"feature{commit}")
+        git(repo, "commit", "-q", "-a", "-m", f"feature work {commit}")
+    git(repo, "checkout", "-q", "main")
+    return repo
+
+def change_files(repo, files, count, lines, tag):
+    for i in range(count):
+        index = (zlib.crc32(tag.encode()) + i * 7919) % files
+        with open(os.path.join(repo, "src", f"module{index // 100}", f"file{index}.py"), "a") as file:
+            file.writelines(f"{tag}_{line} = '{tag}'\n" for line in range(lines))
+
+def drive(command, cwd, env, timeout):
+    """Runs `command` on a pseudo-terminal, pressing Enter at every prompt.
+
+    Returns (wall seconds, exit code, output).
+    """
+    start = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.chdir(cwd)
+        os.execvpe(command[0], command, env)
+    output, selects, reviews = b"", set(), 0
+    while True:
+        if time.perf_counter() - start > timeout:
+            os.kill(pid, signal.SIGKILL)
+            break
+        ready, _, _ = select.select([fd], [], [], 0.05)
+        if not ready:
+            continue
+        try:
+            data = os.read(fd, 65536)
+        except OSError:
+            break
+        if not data:
+            break
+        output += data
+        # prompt_toolkit asks for the cursor position and waits up to a second for an answer.
+        for _ in range(data.count(b"\x1b[6n")):
+            os.write(fd, b"\x1b[1;1R")
+        text = ANSI.sub(b"", output)
+        for prompt in set(SELECT_PROMPT.findall(text)) - selects:
+            selects.add(prompt)
+            os.write(fd, b"\r")
+        while reviews < text.count(REVIEW_PROMPT):
+            reviews += 1
+            os.write(fd, b"\r")
+    _, status = os.waitpid(pid, 0)
+    os.close(fd)
+    return time.perf_counter() - start, os.waitstatus_to_exitcode(status), ANSI.sub(b"", output).decode(errors="replace")
+
+def run_headless(command, cwd, env, timeout):
+    """Runs `command` without a terminal; returns (wall seconds, exit code, output)."""
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True, timeout=timeout)
+    return time.perf_counter() - start, result.returncode, result.stdout
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+def stage_timings(profile_file):
+    """Reads --profile-file output into {stage: [ms per run]}, with "gcpai" and "user wait" added."""
+    runs = {}
+    with open(profile_file) as file:
+        for line in file:
+            record = json.loads(line)
+            stages = runs.setdefault(record["run"], {})
+            if record["name"] == "total":
+                stages["gcpai"] = record["ms"] - record["wait_ms"]
+                stages["user wait"] = record["wait_ms"]
+            else:
+                stages[record["name"]] = stages.get(record["name"], 0.0) + record["ms"]
+    timings = {}
+    for stages in runs.values():
+        for name, ms in stages.items():
+            timings.setdefault(name, []).append(ms)
+    return timings
+
+def run_flow(name, args, root, env):
+    repo = make_repo(os.path.join(root, name), args.files, args.file_lines, args.branch_commits, args.diff_lines)
+    if name == "pr":
+        git(repo, "checkout", "-q", "feature")
+    profile_file = os.path.join(root, f"{name}.jsonl")
+    command = [sys.executable, GCPAI, *FLOWS[name], "--no-cache", "--profile-file", profile_file, *args.gcpai_arg]
+    if not args.pty:
+        command.append("--yes")
+    walls = []
+    for run in range(args.runs + 1):
+        if name != "pr":
+            change_files(repo, args.files, args.changed_files, args.diff_lines, f"{name}{run}")
+        wall, code, output = (drive if args.pty else run_headless)(command, repo, env, args.timeout)
+        if code != 0:
+            sys.exit(f"❌ {name} flow failed with exit code {code}:\n{output}")
+        if run == 0:
+            # The first run warms up filesystem caches and is not counted.
+            os.remove(profile_file)
+            continue
+        walls.append(wall * 1000)
+    timings = stage_timings(profile_file)
+    timings["wall"] = walls
+    return timings
+
+def print_report(name, timings):
+    print(f"\n{name} flow ({len(timings['wall'])} runs)")
+    print(f"  {'stage':<28} {'p50 ms':>9} {'p90 ms':>9} {'max ms':>9}")
+    order = ["wall", "gcpai", "user wait"] + [stage for stage in timings if stage not in ("wall", "gcpai", "user wait")]
+    for stage in order:
+        values = timings[stage]
+        print(f"  {stage[:28]:<28} {percentile(values, 50):>9.1f} {percentile(values, 90):>9.1f} {max(values):>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gcpai's commit, branch and PR flows offline.")
+    parser.add_argument("--flows", nargs="+", choices=list(FLOWS), default=list(FLOWS))
+    parser.add_argument("--runs", type=int, default=5, help="Timed runs per flow.")
+    parser.add_argument("--files", type=int, default=500, help="Tracked files in each synthetic repository.")
+    parser.add_argument("--file-lines", type=int, default=50, help="Lines per tracked file.")
+    parser.add_argument("--changed-files", type=int, default=5, help="Files changed before each commit/branch run.")
+    parser.add_argument("--diff-lines", type=int, default=20, help="Lines added to each changed file.")
+    parser.add_argument("--branch-commits", type=int, default=10, help="Commits on the feature branch used by the PR flow.")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Stub API delay before the first token.")
+    parser.add_argument("--token-ms", type=float, default=2.0, help="Stub API delay per completion token.")
+    parser.add_argument("--tokens", type=int, default=20, help="Stub completion length in tokens.")
+    parser.add_argument("--gcpai-arg", action="append", default=[], metavar="ARG",
+                        help="Extra argument for gcpai (repeatable), e.g. --gcpai-arg=--stream.")
+    parser.add_argument("--pty", action="store_true", help="Answer the interactive prompts through a pseudo-terminal instead of running with --yes.")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Seconds before a run is killed.")
+    parser.add_argument("--max-p50-ms", type=float, help="Fail if the median gcpai time of any flow is above this.")
+    args = parser.parse_args()
+
+    stub = StubOpenAI(0, args.latency_ms, args.token_ms, args.tokens).start()
+    root = tempfile.mkdtemp(prefix="gcpai-bench-")
+    try:
+        bin_dir = os.path.join(root, "bin")
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, "gh"), "w") as file:
+            file.write(GH_STUB)
+        os.chmod(os.path.join(bin_dir, "gh"), 0o755)
+        env = {**os.environ, **GIT_IDENTITY,
+               "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+               "OPENAI_BASE_URL": stub.base_url, "OPENAI_API_KEY": "benchmark",
+               "GCPAI_USAGE_DB": ""}
+
+        print(f"stub: {stub.base_url}  latency: {args.latency_ms:.0f} ms + {args.token_ms:.1f} ms/token x {args.tokens}")
+        print(f"repo: {args.files} files x {args.file_lines} lines, {args.changed_files} changed x {args.diff_lines} lines, "
+              f"{args.branch_commits} feature commits")
+        failed = False
+        for name in args.flows:
+            timings = run_flow(name, args, root, env)
+            print_report(name, timings)
+            if args.max_p50_ms is not None and percentile(timings["gcpai"], 50) > args.max_p50_ms:
+                print(f"❌ Median gcpai time of the {name} flow is over {args.max_p50_ms:.0f} ms.")
+                failed = True
+        print(f"\nAPI requests served: {stub.requests}")
+    finally:
+        stub.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Startup benchmark for the no-op path (`gcpai` with nothing staged).
+
+Creates a throwaway git repository, runs gcpai in it several times and fails
+if the median wall time goes over the budget or if any heavy dependency was
+imported on the way.
+
+    python benchmarks/startup.py --runs 20 --budget-ms 100
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+GCPAI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gcpai.py")
+HEAVY_MODULES = ("openai", "dotenv", "InquirerPy")
+# gcpai checks the key before staging; with it in the environment, .env is never read.
+ENV = {**os.environ, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY") or "benchmark"}
+
+def make_repo(path):
+    subprocess.run(["git", "init", "-q", path], check=True)
+    subprocess.run(["git", "-C", path, "commit", "-q", "--allow-empty", "-m", "init"], check=True,
+                   env={**os.environ, "GIT_AUTHOR_NAME": "bench", "GIT_AUTHOR_EMAIL": "bench@example.com",
+                        "GIT_COMMITTER_NAME": "bench", "GIT_COMMITTER_EMAIL": "bench@example.com"})
+
+def time_run(repo):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, GCPAI], cwd=repo, env=ENV, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 3 or "No staged changes" not in result.stdout:
+        sys.exit(f"Unexpected gcpai output:\n{result.stdout}{result.stderr}")
+    return elapsed
+
+def heavy_imports(repo):
+    # Run main() in-process and report which heavy modules ended up loaded.
+    code = (
+        "import sys, runpy\n"
+        "try:\n"
+        f"    runpy.run_path({GCPAI!r}, run_name='__main__')\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        f"print('loaded:' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=repo, env=ENV, stdout=subprocess.PIPE, text=True, check=True)
+    loaded = result.stdout.rsplit("loaded:", 1)[-1].strip()
+    return [m for m in loaded.split(",") if m]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gcpai startup on the no-op path.")
+    parser.add_argument("--runs", type=int, default=10, help="Number of timed runs.")
+    parser.add_argument("--budget-ms", type=float, default=100.0, help="Maximum allowed median wall time.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as repo:
+        make_repo(repo)
+        time_run(repo)  # warm up filesystem caches
+        timings = [time_run(repo) * 1000 for _ in range(args.runs)]
+        loaded = heavy_imports(repo)
+
+    median = statistics.median(timings)
+    print(f"runs: {args.runs}  median: {median:.1f} ms  min: {min(timings):.1f} ms  max: {max(timings):.1f} ms")
+    print(f"budget: {args.budget_ms:.1f} ms")
+
+    failed = False
+    if loaded:
+        print(f"❌ Heavy modules imported on the no-op path: {', '.join(loaded)}")
+        failed = True
+    if median > args.budget_ms:
+        print("❌ Median startup time is over budget.")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("✅ Startup within budget.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Local OpenAI-compatible stub for offline benchmarks.
+
+Answers `POST /v1/chat/completions` (plain, streamed, `n` > 1 and JSON
+`response_format` requests) after a programmable delay, with canned text of a
+programmable length that fits whatever gcpai asked for: commit message, branch
+name, PR title, PR body or the combined JSON. Point gcpai at it with
+OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+    python benchmarks/stub_openai.py --port 8765 --latency-ms 300 --token-ms 5 --tokens 40
+"""
+
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubOpenAI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency_ms=200.0, token_ms=0.0, tokens=20, cached_tokens=0):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.latency_ms = latency_ms
+        self.token_ms = token_ms
+        self.tokens = tokens
+        self.cached_tokens = cached_tokens
+        self.counter = itertools.count()
+        self.requests = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def answer(self, body, i):
+        """Returns text shaped like what the request's prompt asks for."""
+        prompt = json.dumps(body["messages"])
+        words = " ".join(f"word{k}" for k in range(max(0, self.tokens - 4)))
+        if body.get("response_format"):
+            return json.dumps({"title": f"feat: Benchmark change {i}", "body": f"## Feature\n{words}"})
+        if "Git branch names" in prompt:
+            return f"feat/benchmark-change-{i}"
+        if "Pull Request titles" in prompt:
+            return f"feat: Benchmark change {i}"
+        if "Pull Request" in prompt:
+            return f"## Feature\n{words}"
+        return f"feat: benchmark change {i} {words}".strip()
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        server.requests += 1
+        i = next(server.counter)
+        n = body.get("n", 1)
+        texts = [server.answer(body, i) + (f" {k}" if k else "") for k in range(n)]
+        prompt_tokens = len(json.dumps(body["messages"])) // 4
+        completion_tokens = len(texts[0].split())
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": min(server.cached_tokens, prompt_tokens)},
+        }
+        time.sleep(server.latency_ms / 1000)
+
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for k, word in enumerate(texts[0].split(" ")):
+                self.send_event({"choices": [{"index": 0, "delta": {"content": word if k == 0 else " " + word},
+                                              "finish_reason": None}]})
+                time.sleep(server.token_ms / 1000)
+            self.send_event({"choices": [], "usage": usage})
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+
+        time.sleep(server.token_ms * completion_tokens / 1000)
+        choices = [{"index": k, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                   for k, text in enumerate(texts)]
+        data = json.dumps({"id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+                           "choices": choices, "usage": usage}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_event(self, payload):
+        chunk = {"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": "stub", **payload}
+        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve an OpenAI-compatible stub for gcpai benchmarks.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Delay before the first token.")
+    parser.add_argument("--token-ms", type=float, default=0.0, help="Delay per completion token.")
+    parser.add_argument("--tokens", type=int, default=20, help="Approximate completion length in tokens.")
+    parser.add_argument("--cached-tokens", type=int, default=0, help="Prompt tokens reported as cached.")
+    args = parser.parse_args()
+    server = StubOpenAI(args.port, args.latency_ms, args.token_ms, args.tokens, args.cached_tokens)
+    print(f"Serving on {server.base_url}")
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -4,18 +4,335 @@ import subprocess
 import os
 import argparse
 import sys
-from openai import OpenAI
-from dotenv import load_dotenv
-from InquirerPy import inquirer
-from InquirerPy.base.control import Choice
+import re
+import atexit
+import threading
+import json
+import hashlib
+import time
+import functools
 
-load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+_started = time.perf_counter()
 
-def run_git_command(command, check=True):
+# openai, dotenv and InquirerPy are imported on first use so that quick runs
+# (e.g. nothing staged) don't pay several hundred milliseconds of import time.
+_client = None
+_client_lock = threading.Lock()
+_env_loaded = False
+
+# Counters reported at the end of a run.
+metrics = {
+    "speculative_used": 0,
+    "speculative_discarded": 0,
+    "speculative_discarded_tokens": 0,
+    "speculative_in_flight": 0,
+    "cache_hits": 0,
+    "cache_misses": 0,
+    "summary_cache_hits": 0,
+    "summary_cache_misses": 0,
+    "staged_files": 0,
+    "staging_seconds": 0.0,
+}
+_local = threading.local()
+
+# Run-wide options, filled in from the command line by main().
+settings = {
+    "token_budget": None,
+    "map_reduce": False,
+    "combined_pr": False,
+    "show_usage": False,
+    "offline": False,
+    "profile": False,
+    "profile_file": None,
+    "non_interactive": False,
+    "dry_run": False,
+}
+
+# What the run produced, printed with --json. "status" decides the exit code;
+# it stays None until the run ends, so an early exit(1) reports "failed".
+outcome = {
+    "status": None,
+    "change_type": None,
+    "branch": None,
+    "commit_message": None,
+    "pushed": False,
+    "pull_request": None,
+}
+# Set when the work being prepared in the background is no longer wanted (the
+# push it was waiting for failed); prompts and requests check it before starting.
+abandoned = threading.Event()
+
+EXIT_CODES = {"ok": 0, "failed": 1, "nothing": 3, "canceled": 4, "interrupted": 130}
+
+def load_env():
+    global _env_loaded
+    if not _env_loaded:
+        with Span("import dotenv"):
+            from dotenv import load_dotenv
+            load_dotenv()
+        _env_loaded = True
+
+def env_number(name, default):
+    load_env()
     try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+def ensure_api_key():
+    # .env is only read when the key isn't already in the environment.
+    if not os.getenv("OPENAI_API_KEY"):
+        load_env()
+    if not os.getenv("OPENAI_API_KEY"):
+        print("❌ OPENAI_API_KEY environment variable not set.")
+        exit(1)
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            load_env()
+            with Span("import openai"):
+                from openai import OpenAI
+                _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client
+
+def run_in_background(function, *args, **kwargs):
+    """Runs `function` on a daemon thread and returns a Future for its result.
+
+    Unlike a ThreadPoolExecutor, a pending call never delays interpreter exit.
+    """
+    from concurrent.futures import Future
+    future = Future()
+
+    def worker():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(function(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=worker, daemon=True).start()
+    return future
+
+class Span:
+    """Times one stage of the run for --profile; does nothing unless profiling is on.
+
+    `with Span("git diff") as span:` yields the record, where callers can fill in
+    "bytes_in" and "bytes_out". Token usage reported while a span is open on the
+    same thread is added to it. `wait=True` marks time spent waiting for the user.
+    """
+
+    def __init__(self, name, wait=False):
+        self.record = {"name": name, "wait": wait, "bytes_in": 0, "bytes_out": 0,
+                       "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self.active = False
+
+    def __enter__(self):
+        if settings["profile"] or settings["profile_file"]:
+            self.active = True
+            self.start = time.perf_counter()
+            _local.__dict__.setdefault("spans", []).append(self.record)
+        return self.record
+
+    def __exit__(self, *exc_info):
+        if self.active:
+            self.record["start_ms"] = round((self.start - _started) * 1000, 3)
+            self.record["ms"] = round((time.perf_counter() - self.start) * 1000, 3)
+            self.record["thread"] = threading.current_thread().name
+            _local.spans.pop()
+            with _spans_lock:
+                _spans.append(self.record)
+        return False
+
+_spans = []
+_spans_lock = threading.Lock()
+
+def profiled(name):
+    """Decorator form of Span; a string result is recorded as the bytes out."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Span(name) as span:
+                result = function(*args, **kwargs)
+                if isinstance(result, str):
+                    span["bytes_out"] = len(result)
+                return result
+        return wrapper
+    return decorate
+
+def print_profile():
+    """Prints the --profile table and appends the spans to --profile-file as JSON lines."""
+    total_ms = (time.perf_counter() - _started) * 1000
+    with _spans_lock:
+        spans = list(_spans)
+    if settings["profile_file"]:
+        run = f"{os.getpid()}-{int(time.time())}"
+        with open(settings["profile_file"], "a", encoding="utf-8") as file:
+            for record in spans:
+                file.write(json.dumps({"run": run, **record}) + "\n")
+            file.write(json.dumps({"run": run, "name": "total", "ms": round(total_ms, 3),
+                                   "wait_ms": round(sum(r["ms"] for r in spans if r["wait"]), 3)}) + "\n")
+    if not settings["profile"]:
+        return
+
+    stages = {}
+    for record in spans:
+        stage = stages.setdefault(record["name"], {"calls": 0, "ms": 0.0, "bytes_in": 0, "bytes_out": 0,
+                                                   "prompt_tokens": 0, "completion_tokens": 0})
+        stage["calls"] += 1
+        for field in ("ms", "bytes_in", "bytes_out", "prompt_tokens", "completion_tokens"):
+            stage[field] += record[field]
+    # Spans overlap when work runs in the background, so machine time is the
+    # wall time not spent waiting for the user rather than a sum of stages.
+    wait_ms = sum(record["ms"] for record in spans if record["wait"])
+    print(f"\n⏱️ Profile ({total_ms:.0f} ms wall, {wait_ms:.0f} ms waiting for you, {total_ms - wait_ms:.0f} ms gcpai):")
+    print(f"  {'stage':<28} {'calls':>5} {'ms':>9} {'bytes in':>10} {'bytes out':>10} {'prompt':>8} {'compl.':>7}")
+    for name, stage in stages.items():
+        print(f"  {name[:28]:<28} {stage['calls']:>5} {stage['ms']:>9.1f} {stage['bytes_in']:>10} {stage['bytes_out']:>10} "
+              f"{stage['prompt_tokens']:>8} {stage['completion_tokens']:>7}")
+
+def record_usage(usage):
+    if usage is None:
+        return
+    request = getattr(_local, "request", None)
+    if request and request["start"] is not None:
+        usage_ledger.record(usage, request["model"], request["operation"], request["regenerate"],
+                            time.perf_counter() - request["start"])
+    spans = getattr(_local, "spans", None)
+    if spans:
+        details = getattr(usage, "prompt_tokens_details", None)
+        spans[-1]["prompt_tokens"] += usage.prompt_tokens
+        spans[-1]["cached_tokens"] += getattr(details, "cached_tokens", None) or 0
+        spans[-1]["completion_tokens"] += usage.completion_tokens
+    sink = getattr(_local, "usage", None)
+    if sink is not None:
+        sink.append(usage.total_tokens)
+    elif settings["show_usage"]:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or 0
+        print(f"ℹ️ Tokens: {usage.prompt_tokens} prompt ({cached} cached), {usage.completion_tokens} completion.")
+
+def select_option(message, choices, default=None):
+    if settings["non_interactive"]:
+        return default if default is not None else choices[0][0]
+    with Span("import InquirerPy"):
+        from InquirerPy import inquirer
+        from InquirerPy.base.control import Choice
+    with Span("user: select", wait=True):
+        return inquirer.select(
+            message=message,
+            choices=[Choice(value=value, name=name) for value, name in choices],
+            default=default,
+            vi_mode=True,
+        ).execute()
+
+# Read-only git subcommands whose output can be reused until the repository changes.
+GIT_READ_ONLY = {"rev-parse", "show-ref", "symbolic-ref", "for-each-ref", "diff", "cat-file",
+                 "ls-files", "status", "merge-base", "log", "remote", "ls-remote", "version"}
+# Mutating subcommands that only touch the index; they leave ref queries valid.
+GIT_INDEX_ONLY = {"add", "rm", "mv", "apply"}
+# Mutating subcommands that keep HEAD on the same branch.
+GIT_KEEPS_BRANCH = GIT_INDEX_ONLY | {"commit", "push", "fetch", "tag"}
+
+def _git_subcommand(command):
+    args = command[1:]
+    while args and args[0] in ("-c", "-C"):
+        args = args[2:]
+    while args and args[0].startswith("-"):
+        args = args[1:]
+    return args[0] if args else ""
+
+class GitBackend:
+    """Runs the git commands of a single gcpai invocation.
+
+    Read-only queries are memoized until a command that can change their answer
+    runs, and related lookups are batched into one process.
+    """
+
+    def __init__(self):
+        self._queries = {}
+        self._branch = None
+        self._lock = threading.RLock()
+
+    def run(self, command, check=True, input=None):
+        subcommand = _git_subcommand(command)
+        read_only = input is None and (subcommand in GIT_READ_ONLY or (
+            subcommand == "config" and any(arg.startswith(("--get", "--list")) for arg in command)))
+        key = (tuple(command), check)
+        with self._lock:
+            if read_only and key in self._queries:
+                return self._queries[key]
         result = subprocess.run(
             command,
+            input=input,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            check=check,
+            encoding='utf-8'
+        )
+        output = result.stdout.strip()
+        with self._lock:
+            if read_only:
+                self._queries[key] = output
+            else:
+                self._invalidate(subcommand)
+        return output
+
+    def invalidate(self, subcommand):
+        """Drops cached answers after `git <subcommand>` ran outside this backend."""
+        with self._lock:
+            self._invalidate(subcommand)
+
+    def _invalidate(self, subcommand):
+        if subcommand in GIT_INDEX_ONLY:
+            self._queries = {k: v for k, v in self._queries.items()
+                             if _git_subcommand(k[0]) not in ("diff", "status", "ls-files")}
+            return
+        self._queries.clear()
+        if subcommand not in GIT_KEEPS_BRANCH:
+            self._branch = None
+
+    def current_branch(self):
+        with self._lock:
+            if self._branch is None:
+                self._branch = run_git_command(["git", "rev-parse", "--abbrev-ref", "HEAD"])
+            return self._branch
+
+    def refs(self, prefix):
+        """Returns {refname: object id} for every ref under `prefix` in one call."""
+        output = run_git_command(["git", "for-each-ref", "--format=%(refname) %(objectname)", prefix])
+        return dict(line.split(" ", 1) for line in output.splitlines() if line)
+
+    def object_sizes(self, oids):
+        """Returns {object id: size} for many objects with one `git cat-file --batch-check`."""
+        if not oids:
+            return {}
+        result = subprocess.run(
+            ["git", "cat-file", "--batch-check=%(objectname) %(objectsize)"],
+            input="\n".join(oids) + "\n",
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        sizes = {}
+        for line in result.stdout.splitlines():
+            oid, _, size = line.partition(" ")
+            if size.isdigit():
+                sizes[oid] = int(size)
+        return sizes
+
+git = GitBackend()
+
+def run_git_command(command, check=True, input=None):
+    try:
+        if command[0] == "git":
+            return git.run(command, check=check, input=input)
+        result = subprocess.run(
+            command,
+            input=input,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
@@ -31,58 +348,856 @@ def run_git_command(command, check=True):
         print(f"❌ git command not found. Please ensure Git is installed and in your PATH.")
         exit(1)
 
+def staging_options():
+    """`-c` options that speed up the worktree scan, unless the repository sets them itself.
+
+    The untracked cache lets git skip directories whose mtime didn't change, and the
+    builtin fsmonitor daemon (git 2.37+ on macOS and Windows) avoids a stat() per file.
+    """
+    configured = run_git_command(["git", "config", "--get-regexp", r"^core\.(fsmonitor|untrackedcache)$"], check=False)
+    keys = {line.split(" ", 1)[0] for line in configured.splitlines()}
+    options = []
+    if "core.untrackedcache" not in keys:
+        options += ["-c", "core.untrackedCache=true"]
+    if "core.fsmonitor" not in keys and sys.platform in ("darwin", "win32"):
+        version = tuple(int(part) for part in re.findall(r"\d+", run_git_command(["git", "version"]))[:2])
+        if version >= (2, 37):
+            options += ["-c", "core.fsmonitor=true"]
+    return options
+
+@profiled("git add")
+def stage_changes(pathspecs):
+    """Stages everything under `pathspecs` like `git add`, but only passes `git add` the
+    paths `git status --porcelain=v2` reports as changed, and skips it when there are none."""
+    start = time.perf_counter()
+    options = staging_options()
+    output = run_git_command(["git", *options, "status", "--porcelain=v2", "-z", "--", *pathspecs])
+    fields = output.split("\0")
+    paths = []
+    i = 0
+    while i < len(fields):
+        field = fields[i]
+        i += 1
+        if field.startswith("? "):
+            paths.append(field[2:])
+        elif field.startswith(("1 ", "2 ", "u ")):
+            # Ordinary, renamed and unmerged entries have 9, 10 and 11 space-separated fields.
+            parts = field.split(" ", {"1": 8, "2": 9, "u": 10}[field[0]])
+            if field[0] == "2":
+                i += 1  # the original path of a rename follows as its own field
+            if field[0] == "u" or parts[1][1] != ".":
+                paths.append(parts[-1])
+    if paths:
+        # One `git add` however many paths changed; stdin has no argument-length limit.
+        run_git_command(["git", *options, "add", "-A", "--pathspec-from-file=-", "--pathspec-file-nul"],
+                        input="".join(f":(top,literal){path}\0" for path in paths))
+    metrics["staged_files"] += len(paths)
+    metrics["staging_seconds"] += time.perf_counter() - start
+
+# Files whose content only bloats prompts; they are listed as one-line stats instead.
+EXCLUDED_PATTERNS = [
+    "package-lock.json", "npm-shrinkwrap.json", "yarn.lock", "pnpm-lock.yaml", "bun.lockb",
+    "poetry.lock", "Pipfile.lock", "uv.lock", "Cargo.lock", "Gemfile.lock", "composer.lock",
+    "go.sum", "*.min.js", "*.min.css", "*.map", "*.snap", "__snapshots__/", "vendor/", "node_modules/",
+]
+# .gitattributes settings that mark a file as generated, vendored or not diffable.
+EXCLUDED_ATTRIBUTES = [
+    "linguist-generated", "linguist-generated=true",
+    "linguist-vendored", "linguist-vendored=true",
+    "-diff",
+]
+# Project-specific patterns, one per line, in .gitignore-style glob syntax.
+IGNORE_FILE = ".gcpaiignore"
+
+def _glob_pathspec(pattern):
+    pattern = pattern.lstrip("/") if pattern.startswith("/") else f"**/{pattern}"
+    return pattern + "**" if pattern.endswith("/") else pattern
+
+def excluded_pathspecs():
+    """Returns pathspecs matching every file whose content is kept out of prompts."""
+    patterns = list(EXCLUDED_PATTERNS)
+    top = run_git_command(["git", "rev-parse", "--show-toplevel"])
+    try:
+        with open(os.path.join(top, IGNORE_FILE), encoding='utf-8') as f:
+            patterns += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    except OSError:
+        pass
+    pathspecs = [f":(top,glob){_glob_pathspec(pattern)}" for pattern in patterns]
+    pathspecs += [f":(top,attr:{attribute})" for attribute in EXCLUDED_ATTRIBUTES]
+    return pathspecs
+
+def excluded_file_stats(revision, pathspecs, check=True):
+    """One line per excluded file (`M package-lock.json +1200 -900`), read with --raw/--numstat only."""
+    output = run_git_command(["git", "diff", *revision, "--no-renames", "--raw", "--numstat", "--", *pathspecs], check=check)
+    statuses, stats = {}, []
+    for line in output.splitlines():
+        if line.startswith(":"):
+            meta, path = line.split("\t", 1)
+            statuses[path] = meta.split()[-1]
+        elif line:
+            added, removed, path = line.split("\t", 2)
+            change = "binary" if added == "-" else f"+{added} -{removed}"
+            stats.append(f"{statuses.get(path, 'M')} {path} {change}")
+    if not stats:
+        return ""
+    return "Files omitted from the diff (lockfiles, generated, vendored or binary):\n" + "\n".join(stats)
+
+_fetched_branches = set()
+
+@profiled("git fetch")
+def fetch_base_branch(base_branch):
+    """Brings origin/<base_branch> up to date before a PR diff, fetching only when needed.
+
+    Nothing is fetched with --offline, or when FETCH_HEAD or the remote ref
+    changed within GCPAI_FETCH_TTL seconds (default 300). When the merge base
+    is already present, the fetch skips tags and submodules and, in partial
+    clones, blobs.
+    """
+    if base_branch in _fetched_branches or settings["offline"]:
+        return
+    _fetched_branches.add(base_branch)
+
+    paths = run_git_command(["git", "rev-parse", "--git-path", "FETCH_HEAD",
+                             "--git-path", f"logs/refs/remotes/origin/{base_branch}"]).splitlines()
+    last_update = max((os.path.getmtime(path) for path in paths if os.path.exists(path)), default=0)
+    if time.time() - last_update < env_number("GCPAI_FETCH_TTL", 300):
+        return
+
+    command = ["git", "fetch", "origin", base_branch]
+    if run_git_command(["git", "merge-base", f"origin/{base_branch}", "HEAD"], check=False):
+        command += ["--no-tags", "--no-recurse-submodules"]
+        if run_git_command(["git", "config", "--get", "remote.origin.promisor"], check=False) == "true":
+            command.append("--filter=blob:none")
+    run_git_command(command, check=False)
+
+# Bytes read per call while streaming a diff; longer lines are cut at this length.
+DIFF_READ_CHUNK = 64 * 1024
+
+def _unquote_path(text):
+    """Undoes git's C-style quoting of paths with special or non-ASCII characters."""
+    if len(text) < 2 or not (text.startswith('"') and text.endswith('"')):
+        return text
+    return text[1:-1].encode("utf-8").decode("unicode_escape").encode("latin-1").decode("utf-8", "replace")
+
+def _diff_path(line):
+    """The new path of a `diff --git a/<old> b/<new>` line."""
+    rest = line[len("diff --git "):]
+    if rest.endswith('"'):
+        # Quotes inside a quoted path are escaped, so ` "b/` only starts the new path.
+        return _unquote_path(rest[rest.rfind(' "b/') + 1:])[2:]
+    return rest.split(" b/", 1)[-1]
+
+def read_git_diff(command, check=True, max_chars=None, max_file_chars=None, paths=None):
+    """Streams the output of a `git diff` command, keeping at most `max_chars` characters
+    of changes in total and `max_file_chars` per file, and only the files in `paths` if given.
+
+    Each file's metadata lines before its first hunk are always kept and don't count
+    toward either limit. Hunk lines past a limit are counted and discarded as they
+    arrive, and each file that lost lines ends with a one-line note, so a huge
+    accidental diff never has to fit in memory. Returns (diff, skipped bytes).
+    """
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError:
+        print("❌ git command not found. Please ensure Git is installed and in your PATH.")
+        exit(1)
+    kept, kept_chars, skipped = [], 0, 0
+    path, file_chars, dropped, wanted, header = "", 0, [0, 0, 0], True, False
+
+    def note_dropped():
+        if dropped[0]:
+            kept.append(f"... [skipped {dropped[0]} more lines (+{dropped[1]} -{dropped[2]}) of {path}]")
+
+    while True:
+        raw = process.stdout.readline(DIFF_READ_CHUNK)
+        if not raw:
+            break
+        if not raw.endswith(b"\n"):
+            # Overlong line (minified or binary-ish data): keep its start, skip the rest.
+            while True:
+                rest = process.stdout.readline(DIFF_READ_CHUNK)
+                skipped += len(rest)
+                if not rest or rest.endswith(b"\n"):
+                    break
+        line = raw.decode('utf-8', 'replace').rstrip("\n")
+        if line.startswith("diff --git "):
+            note_dropped()
+            path, file_chars, dropped, header = _diff_path(line), 0, [0, 0, 0], True
+            wanted = paths is None or path in paths
+            if wanted:
+                kept.append(line)
+            continue
+        if not wanted:
+            continue
+        header = header and not line.startswith("@@")
+        if header:
+            kept.append(line)
+            continue
+        cost = len(line) + 1
+        if ((max_chars is None or kept_chars + cost <= max_chars)
+                and (max_file_chars is None or file_chars + cost <= max_file_chars)):
+            kept.append(line)
+            kept_chars += cost
+            file_chars += cost
+            continue
+        skipped += len(raw)
+        dropped[0] += 1
+        if line.startswith("+"):
+            dropped[1] += 1
+        elif line.startswith("-"):
+            dropped[2] += 1
+    note_dropped()
+    error = process.stderr.read().decode('utf-8', 'replace')
+    if process.wait() and check:
+        print(f"❌ Error executing: {' '.join(command)}")
+        print(f"  {error.strip()}")
+        exit(1)
+    return "\n".join(kept).strip(), skipped
+
+# Rough size of a diff line, and the hunk header and context lines around a change,
+# for planning reads from line counts.
+DIFF_LINE_CHARS = 60
+DIFF_HUNK_LINES = 7
+
+def diff_line_counts(revision, excludes, check=True):
+    """Changed lines (added + removed) of every file in `revision`, from `--numstat` alone."""
+    output = run_git_command(["git", "diff", *revision, "--numstat", "-z", "--", ":/", *excludes], check=check)
+    fields = output.split("\0")
+    counts = []
+    i = 0
+    while i < len(fields):
+        if not fields[i]:
+            i += 1
+            continue
+        added, removed, path = fields[i].split("\t", 2)
+        # Renames leave the path empty; the old and new paths follow as their own fields.
+        i += 1 if path else 3
+        counts.append(0 if added == "-" else int(added) + int(removed))
+    return counts
+
+def fair_share(budget, sizes):
+    """The per-item cap that splits `budget` across `sizes`: small items fit whole and
+    the rest share what is left equally. None when everything fits."""
+    remaining = budget
+    ordered = sorted(sizes)
+    for i, size in enumerate(ordered):
+        share = remaining // (len(ordered) - i)
+        if size > share:
+            return share
+        remaining -= size
+    return None
+
+def _format_size(size):
+    if size < 1024:
+        return f"{size} B"
+    return f"{size / 1024 / 1024:.1f} MB" if size >= 1024 * 1024 else f"{size / 1024:.0f} KB"
+
+def check_staged_size(entries):
+    """Pre-flight size check on the staged files, from blob sizes alone (nothing is diffed).
+
+    Returns [(status, path, size)] for files over GCPAI_MAX_FILE_KB (512), which go into
+    the prompt as a size line instead of a diff. Of the files that will be diffed, aborts
+    before anything is sent when their staged content exceeds GCPAI_MAX_STAGED_MB (100)
+    and warns above GCPAI_WARN_STAGED_MB (10); deletions and pure renames add nothing.
+    A threshold of 0 disables it.
+    """
+    if not entries:
+        return []
+    sizes = git.object_sizes([oid for entry in entries for oid in (entry["old"], entry["new"]) if oid.strip("0")])
+    max_file = env_number("GCPAI_MAX_FILE_KB", 512) * 1024
+    staged, oversized = [], []
+    for entry in entries:
+        deleted = entry["status"] == "D"
+        size = sizes.get(entry["old"] if deleted else entry["new"], 0)
+        if max_file and size > max_file:
+            oversized.append((entry["status"][0], entry["path"], size))
+        elif not deleted and entry["old"] != entry["new"]:
+            staged.append((size, entry["path"]))
+    if not staged:
+        return oversized
+
+    total = sum(size for size, _ in staged)
+    largest = ", ".join(f"{path} ({_format_size(size)})" for size, path in sorted(staged, reverse=True)[:3])
+    max_staged = env_number("GCPAI_MAX_STAGED_MB", 100) * 1024 * 1024
+    warn_staged = env_number("GCPAI_WARN_STAGED_MB", 10) * 1024 * 1024
+    if max_staged and total > max_staged:
+        print(f"❌ Staged changes add {_format_size(total)}, over the {_format_size(max_staged)} limit. Largest: {largest}.")
+        print("  Unstage them with `git reset <path>`, or raise GCPAI_MAX_STAGED_MB.")
+        exit(1)
+    if warn_staged and total > warn_staged:
+        print(f"⚠️ Staged changes add {_format_size(total)}. Largest: {largest}.")
+    return oversized
+
+def branch_revision(base_branch):
+    """The `git diff` revision of a PR into `base_branch`: the branch's commits, plus the
+    staged changes under --dry-run, where they are never committed."""
+    fetch_base_branch(base_branch)
+    if settings["dry_run"]:
+        merge_base = run_git_command(["git", "merge-base", f"origin/{base_branch}", "HEAD"], check=False)
+        if merge_base:
+            return ["--cached", merge_base]
+    return [f"origin/{base_branch}...HEAD"]
+
+@profiled("git diff")
 def get_git_diff(staged=True, base_branch=None):
     if staged:
-        return run_git_command(["git", "diff", "--cached"])
+        revision, check = ["--cached"], True
     elif base_branch:
-        run_git_command(["git", "fetch", "origin", base_branch], check=False)
-        return run_git_command(["git", "diff", f"origin/{base_branch}...HEAD"], check=False)
+        revision, check = branch_revision(base_branch), False
+    else:
+        return ""
+    # Excluded files are filtered out by git itself, so their content never reaches Python.
+    pathspecs = excluded_pathspecs()
+    excludes = [spec.replace(":(top,", ":(top,exclude,", 1) for spec in pathspecs]
+    entries, large, oversized = None, [], ""
+    if staged:
+        entries = changed_files(revision, excludes)
+        large = check_staged_size(entries)
+        if large:
+            paths = {path for _, path, _ in large}
+            excludes += [f":(top,exclude,literal){path}" for entry in entries if entry["path"] in paths
+                         for path in {entry["path"], entry["old_path"]}]
+            oversized = "Files too large to include in the diff:\n" + "\n".join(
+                f"{status} {path} ({_format_size(size)})" for status, path, size in large)
+    diff = ""
+    if entries is None or len(entries) > len(large):
+        # Read about twice the token budget (at ~4 characters per token) so compaction
+        # still has something to choose from. The budget is shared across files by their
+        # --numstat line counts, so early paths can't starve later ones, and no single
+        # file may take more than half.
+        budget = token_budget()
+        max_chars = budget * 8 if budget > 0 else None
+        max_file_chars = None
+        if max_chars:
+            lines = diff_line_counts(revision, excludes, check=check)
+            share = fair_share(max_chars, [(count + DIFF_HUNK_LINES) * DIFF_LINE_CHARS for count in lines])
+            max_file_chars = min(share or max_chars, max_chars // 2)
+        diff, skipped = read_git_diff(["git", "diff", *revision, "--", ":/", *excludes], check=check,
+                                      max_chars=max_chars, max_file_chars=max_file_chars)
+        if skipped:
+            print(f"📥 Skipped {skipped / 1024:.0f} KB of diff beyond the token budget without loading it.")
+    stats = excluded_file_stats(revision, pathspecs, check=check)
+    return "\n".join(part for part in (stats, oversized, diff) if part)
+
+_encoding = None
+
+def count_tokens(text):
+    """Counts tokens with tiktoken when it is installed, or estimates ~4 characters per token."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+SKIPPED_NOTE = re.compile(r"\.\.\. \[skipped \d+ more lines \(\+(\d+) -(\d+)\) of ")
+
+def parse_diff(diff):
+    """Splits a unified diff into files: {"path", "header", "hunks", "added", "removed"}.
+
+    Any text before the first file (such as the omitted-files list) is kept as
+    an entry with an empty path.
+    """
+    current = {"path": "", "header": [], "hunks": [], "added": 0, "removed": 0}
+    files = [current]
+    for line in diff.splitlines():
+        if line.startswith("diff --git "):
+            current = {"path": _diff_path(line), "header": [line], "hunks": [], "added": 0, "removed": 0}
+            files.append(current)
+        elif line.startswith("@@"):
+            current["hunks"].append([line])
+        elif not current["hunks"]:
+            current["header"].append(line)
+            if line.startswith(("+++ b/", '+++ "b/')):
+                current["path"] = _unquote_path(line[len("+++ "):])[2:]
+        else:
+            current["hunks"][-1].append(line)
+            if line.startswith("+"):
+                current["added"] += 1
+            elif line.startswith("-"):
+                current["removed"] += 1
+        # Lines read_git_diff skipped still count toward the file's size.
+        skipped = SKIPPED_NOTE.match(line)
+        if skipped:
+            current["added"] += int(skipped.group(1))
+            current["removed"] += int(skipped.group(2))
+    return files if files[0]["header"] else files[1:]
+
+def render_file(file):
+    lines = list(file["header"])
+    for hunk in file["hunks"]:
+        lines.extend(hunk)
+    return "\n".join(lines)
+
+def _header_value(file, prefix):
+    for line in file["header"]:
+        if line.startswith(prefix):
+            return line[len(prefix):]
+    return None
+
+def _collapse_metadata_only(file):
+    if file["hunks"] or not file["path"]:
+        return
+    if any(line.startswith("Binary files ") for line in file["header"]):
+        file["header"] = [f"binary: {file['path']}"]
+        return
+    rename_from, rename_to = _header_value(file, "rename from "), _header_value(file, "rename to ")
+    old_mode, new_mode = _header_value(file, "old mode "), _header_value(file, "new mode ")
+    if rename_from and rename_to:
+        summary = f"renamed: {rename_from} -> {rename_to}"
+        if old_mode and new_mode:
+            summary += f" (mode {old_mode} -> {new_mode})"
+        file["header"] = [summary]
+    elif old_mode and new_mode:
+        file["header"] = [f"mode changed: {file['path']} ({old_mode} -> {new_mode})"]
+
+def _is_whitespace_only(hunk):
+    removed = "".join("".join(line[1:].split()) for line in hunk[1:] if line.startswith("-"))
+    added = "".join("".join(line[1:].split()) for line in hunk[1:] if line.startswith("+"))
+    return removed == added
+
+def _reduce_context(hunk, context):
+    changed = [i for i, line in enumerate(hunk) if i and line[:1] in ("+", "-")]
+    kept = [hunk[0]]
+    for i, line in enumerate(hunk[1:], start=1):
+        if line[:1] in ("+", "-", "\\", ".") or any(abs(i - c) <= context for c in changed):
+            kept.append(line)
+    return kept
+
+def _truncate_file(file, budget):
+    lines = render_file(file).splitlines()
+    kept, used = [], 0
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if kept and used + cost > budget:
+            break
+        kept.append(line)
+        used += cost
+    if len(kept) < len(lines):
+        kept.append(f"... [truncated {len(lines) - len(kept)} more lines of {file['path']}]")
+    return {**file, "header": kept, "hunks": []}
+
+def compact_diff(diff, budget, context=1):
+    """Fits `diff` into roughly `budget` tokens, losing as little as possible.
+
+    Renames and mode changes are always collapsed to one line and whitespace-only
+    hunks dropped. While still over budget, deleted files are summarized, context
+    lines reduced to `context`, and finally each file is truncated to a fair share
+    of the budget, with small files kept whole. Over budget, files are ordered by change
+    size, after any text that precedes them (such as the omitted-files list).
+    """
+    files = parse_diff(diff)
+    for file in files:
+        _collapse_metadata_only(file)
+        hunks = [hunk for hunk in file["hunks"] if not _is_whitespace_only(hunk)]
+        if file["hunks"] and not hunks:
+            file["header"] = [f"whitespace-only changes: {file['path']}"]
+        file["hunks"] = hunks
+
+    def total():
+        return sum(count_tokens(render_file(file)) for file in files)
+
+    if budget and total() > budget:
+        preamble = [file for file in files if not file["path"]]
+        files = preamble + sorted((file for file in files if file["path"]),
+                                  key=lambda file: file["added"] + file["removed"], reverse=True)
+
+    if budget and total() > budget:
+        for file in files:
+            if _header_value(file, "deleted file mode") is not None:
+                file["header"] = [f"deleted: {file['path']} (-{file['removed']} lines)"]
+                file["hunks"] = []
+    if budget and total() > budget:
+        for file in files:
+            file["hunks"] = [_reduce_context(hunk, context) for hunk in file["hunks"]]
+    if budget and total() > budget:
+        sizes = {id(file): count_tokens(render_file(file)) for file in files}
+        allocation = {}
+        remaining = budget
+        by_size = sorted(files, key=lambda file: sizes[id(file)])
+        for i, file in enumerate(by_size):
+            allocation[id(file)] = min(sizes[id(file)], remaining // (len(by_size) - i))
+            remaining -= allocation[id(file)]
+        files = [file if sizes[id(file)] <= allocation[id(file)] else _truncate_file(file, allocation[id(file)])
+                 for file in files]
+    return "\n".join(render_file(file) for file in files)
+
+def token_budget():
+    """Prompt token budget from --token-budget or GCPAI_TOKEN_BUDGET (12000); 0 disables it."""
+    budget = settings["token_budget"]
+    if budget is None:
+        budget = int(env_number("GCPAI_TOKEN_BUDGET", 12000))
+    return budget
+
+@profiled("compact diff")
+def prepare_diff(diff):
+    """Compacts `diff` to the token budget before it is pasted into prompts."""
+    if not diff:
+        return diff
+    budget = token_budget()
+    if budget <= 0:
+        return diff
+    compacted = compact_diff(diff, budget)
+    before, after = count_tokens(diff), count_tokens(compacted)
+    if after < before:
+        print(f"📉 Diff compacted from {before} to {after} tokens (budget {budget}).")
+    return compacted
+
+class ResponseCache:
+    """Content-addressed store of API responses under `.git/<name>/`.
+
+    Entries are keyed by a hash of whatever determines the response (for API
+    calls: model, temperature, candidate count and full prompt), and evicted by
+    age (GCPAI_CACHE_MAX_AGE_DAYS, default 7) and total size (GCPAI_CACHE_MAX_MB,
+    default 20). Hits and misses are counted in `metrics` under `<metric>_hits`
+    and `<metric>_misses`.
+    """
+
+    def __init__(self, name="gcpai-cache", metric="cache"):
+        self.enabled = True
+        self.name = name
+        self.metric = metric
+        self._directory = None
+
+    def directory(self):
+        if self._directory is None:
+            git_dir = run_git_command(["git", "rev-parse", "--git-common-dir"])
+            self._directory = os.path.join(os.path.abspath(git_dir), self.name)
+        return self._directory
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.directory(), f"{key}.json")
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            metrics[f"{self.metric}_misses"] += 1
+            return None
+        if time.time() - entry["created"] > env_number("GCPAI_CACHE_MAX_AGE_DAYS", 7) * 86400:
+            metrics[f"{self.metric}_misses"] += 1
+            return None
+        metrics[f"{self.metric}_hits"] += 1
+        return entry["response"]
+
+    def put(self, key, response):
+        directory = self.directory()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{key}.json")
+            with open(f"{path}.tmp", "w", encoding='utf-8') as f:
+                json.dump({"created": time.time(), "response": response}, f)
+            os.replace(f"{path}.tmp", path)
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        directory = self.directory()
+        max_age = env_number("GCPAI_CACHE_MAX_AGE_DAYS", 7) * 86400
+        max_size = env_number("GCPAI_CACHE_MAX_MB", 20) * 1024 * 1024
+        now = time.time()
+        entries = []
+        for entry in os.scandir(directory):
+            stat = entry.stat()
+            if now - stat.st_mtime > max_age:
+                os.remove(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            os.remove(path)
+            total -= size
+
+def user_config_dir():
+    if sys.platform == "win32":
+        base = os.getenv("APPDATA") or os.path.expanduser("~")
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Application Support")
+    else:
+        base = os.getenv("XDG_CONFIG_HOME") or os.path.expanduser("~/.config")
+    return os.path.join(base, "gcpai")
+
+# USD per million tokens: (prompt, cached prompt, completion). Used for estimates only.
+MODEL_PRICES = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+}
+
+def _public_remote_url(url):
+    """Returns `url` without user or password, or "" for remotes that are local paths."""
+    if "://" in url:
+        from urllib.parse import urlsplit, urlunsplit
+        parts = urlsplit(url)
+        if parts.scheme == "file" or not parts.hostname:
+            return ""
+        host = parts.netloc.rsplit("@", 1)[-1]
+        return urlunsplit((parts.scheme, host, parts.path, "", ""))
+    # scp-like syntax (`git@github.com:owner/repo.git`) has a colon before any slash;
+    # its user is a login name, never a secret.
+    match = re.match(r"[^/]+?:", url)
+    if match and len(match.group(0)) > 2:
+        return url
     return ""
 
-def get_openai_suggestion(prompt, model="gpt-4o-mini", temperature=0.3):
+class UsageLedger:
+    """Append-only SQLite log of every API call's token usage, shared by all repositories.
+
+    Lives in the user config directory unless GCPAI_USAGE_DB names another file;
+    an empty GCPAI_USAGE_DB turns it off. Failing to write never stops a run.
+    """
+
+    GROUPS = ("repo", "day", "operation", "model", "regenerate")
+
+    def __init__(self):
+        self._path = None
+        self._repo = None
+        self._lock = threading.Lock()
+        self._warned = False
+
+    def path(self):
+        if self._path is None:
+            self._path = os.getenv("GCPAI_USAGE_DB", os.path.join(user_config_dir(), "usage.sqlite3"))
+        return self._path
+
+    def connect(self):
+        import sqlite3
+        os.makedirs(os.path.dirname(os.path.abspath(self.path())), exist_ok=True)
+        connection = sqlite3.connect(self.path(), timeout=5)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS calls (time REAL, day TEXT, repo TEXT, operation TEXT, model TEXT,"
+            " regenerate INTEGER, prompt_tokens INTEGER, cached_tokens INTEGER, completion_tokens INTEGER,"
+            " latency_ms REAL)"
+        )
+        return connection
+
+    def repo(self):
+        """The origin URL without credentials; the top-level path for local or missing remotes."""
+        if self._repo is None:
+            url = run_git_command(["git", "config", "--get", "remote.origin.url"], check=False)
+            self._repo = (_public_remote_url(url)
+                          or run_git_command(["git", "rev-parse", "--show-toplevel"], check=False))
+        return self._repo
+
+    def record(self, usage, model, operation, regenerate, latency):
+        if not self.path():
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        row = (time.time(), time.strftime("%Y-%m-%d"), self.repo(), operation, model, regenerate,
+               usage.prompt_tokens, getattr(details, "cached_tokens", None) or 0, usage.completion_tokens,
+               round(latency * 1000, 1))
+        try:
+            with self._lock:
+                connection = self.connect()
+                with connection:
+                    connection.execute("INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                connection.close()
+        except Exception as e:
+            if not self._warned:
+                self._warned = True
+                print(f"⚠️ Couldn't write the usage ledger at {self.path()}: {e}")
+
+    def summary(self, group, days=None, repo=None):
+        """Returns rows of (group value, model, calls, prompt, cached, completion tokens, mean latency ms)."""
+        where, params = [], []
+        if days:
+            where.append("time >= ?")
+            params.append(time.time() - days * 86400)
+        if repo:
+            where.append("repo LIKE ?")
+            params.append(f"%{repo}%")
+        # `group` is one of GROUPS, never user text, so it can be interpolated.
+        query = (f"SELECT {group}, model, COUNT(*), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens),"
+                 f" AVG(latency_ms) FROM calls {'WHERE ' + ' AND '.join(where) if where else ''}"
+                 f" GROUP BY {group}, model ORDER BY {group}")
+        connection = self.connect()
+        try:
+            return connection.execute(query, params).fetchall()
+        finally:
+            connection.close()
+
+usage_ledger = UsageLedger()
+
+def estimate_cost(model, prompt, cached, completion):
+    prices = MODEL_PRICES.get(model)
+    if prices is None:
+        return None
+    return ((prompt - cached) * prices[0] + cached * prices[1] + completion * prices[2]) / 1_000_000
+
+def print_stats(argv):
+    """`gcpai stats`: API usage from the ledger, grouped by repo, day, operation, model or regenerate count."""
+    parser = argparse.ArgumentParser(prog="gcpai stats", description="Summarizes gcpai's API usage across runs.")
+    parser.add_argument("--by", choices=list(UsageLedger.GROUPS), action="append",
+                        help="Group by this column; repeat for several tables (default: repo, day, operation, regenerate).")
+    parser.add_argument("--days", type=int, default=30, help="Only count the last N days (default 30; 0 for all).")
+    parser.add_argument("--repo", help="Only count repositories whose remote or path contains this text.")
+    args = parser.parse_args(argv)
+    load_env()  # GCPAI_USAGE_DB may be set in .env
+    if not usage_ledger.path() or not os.path.exists(usage_ledger.path()):
+        print("ℹ️ No usage recorded yet.")
+        return
+
+    for group in args.by or ["repo", "day", "operation", "regenerate"]:
+        totals = {}
+        for value, model, calls, prompt, cached, completion, latency in usage_ledger.summary(group, args.days, args.repo):
+            total = totals.setdefault(value, [0, 0, 0, 0, 0.0, 0.0])
+            cost = estimate_cost(model, prompt, cached, completion)
+            total[0] += calls
+            total[1] += prompt
+            total[2] += cached
+            total[3] += completion
+            total[4] += latency * calls
+            total[5] = None if cost is None or total[5] is None else total[5] + cost
+        print(f"\n📊 By {group}:")
+        print(f"  {group:<40} {'calls':>6} {'prompt':>10} {'cached':>9} {'compl.':>8} {'avg prompt':>10} {'avg ms':>7} {'cost $':>8}")
+        for value, (calls, prompt, cached, completion, latency, cost) in totals.items():
+            cost_text = f"{cost:.4f}" if cost is not None else "?"
+            print(f"  {str(value)[-40:]:<40} {calls:>6} {prompt:>10} {cached:>9} {completion:>8} "
+                  f"{prompt // calls:>10} {latency / calls:>7.0f} {cost_text:>8}")
+
+response_cache = ResponseCache()
+summary_cache = ResponseCache("gcpai-summaries", "summary_cache")
+
+def get_openai_suggestion(prompt, model="gpt-4o-mini", temperature=0.3, stream=False, transform=None, n=1, cache=True, response_format=None, system=None, operation="suggestion", regenerate=0):
+    """Returns the model's answer to `prompt`, or a list of `n` answers when n > 1.
+
+    `system`, when given, is sent as a separate system message ahead of `prompt`.
+
+    With `stream`, tokens are echoed to stdout as they arrive, passed through
+    `transform` (the caller's post-processing) so the echo matches the final text.
+    Multi-candidate and structured (`response_format`) requests are never streamed.
+    With `cache`, identical requests are answered from the on-disk response cache.
+    `operation` names the request (commit, branch, title...) in --profile reports and
+    the usage ledger, which also records how many suggestions were rejected before it.
+    """
+    _local.request = {"operation": operation, "model": model, "regenerate": regenerate, "start": None}
+    with Span(f"openai {operation}") as span:
+        span["bytes_in"] = len(prompt) + len(system or "")
+        suggestion = _cached_suggestion(prompt, model, temperature, stream, transform, n, cache, response_format, system)
+        span["bytes_out"] = sum(map(len, suggestion)) if isinstance(suggestion, list) else len(suggestion)
+    return suggestion
+
+def _cached_suggestion(prompt, model, temperature, stream, transform, n, cache, response_format, system):
+    cache_key = None
+    if cache and response_cache.enabled:
+        cache_key = response_cache.key(model, temperature, n, system, prompt, response_format)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            if stream and n == 1:
+                print(transform(cached) if transform else cached)
+            return cached
+    speculation = getattr(_local, "speculation", None)
+    if speculation is not None:
+        speculation["prompt_tokens"] = count_tokens(prompt) + count_tokens(system or "")
+    messages = [{"role": "user", "content": prompt}]
+    if system:
+        messages.insert(0, {"role": "system", "content": system})
+    suggestion = _request_suggestion(messages, model, temperature, stream, transform, n, response_format)
+    if cache_key:
+        response_cache.put(cache_key, suggestion)
+    return suggestion
+
+def _create_completion(**options):
+    client = get_client()
+    # The ledger's latency covers the API call only, not importing and building the client.
+    request = getattr(_local, "request", None)
+    if request:
+        request["start"] = time.perf_counter()
+    return client.chat.completions.create(**options)
+
+def _request_suggestion(messages, model, temperature, stream, transform, n, response_format):
     try:
-        response = client.chat.completions.create(
+        if not stream or n > 1 or response_format:
+            options = {"response_format": response_format} if response_format else {}
+            response = _create_completion(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                n=n,
+                **options,
+            )
+            record_usage(response.usage)
+            suggestions = [choice.message.content.strip().replace("`", "") for choice in response.choices]
+            return suggestions if n > 1 else suggestions[0]
+
+        response = _create_completion(
             model=model,
-            messages=[{"role": "user", "content": prompt}],
+            messages=messages,
             temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
         )
-        return response.choices[0].message.content.strip().replace("`", "")
+        content = ""
+        echoed = ""
+        usage = None
+        for chunk in response:
+            usage = chunk.usage or usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            content += chunk.choices[0].delta.content.replace("`", "")
+            rendered = content.lstrip()
+            if transform:
+                rendered = transform(rendered)
+            # Only echo text that later tokens can't change; anything else is fixed up at the end.
+            if rendered.startswith(echoed):
+                print(rendered[len(echoed):], end="", flush=True)
+                echoed = rendered
+        print()
+        suggestion = content.strip()
+        final = transform(suggestion) if transform else suggestion
+        if final != echoed.strip():
+            print(final)
+        record_usage(usage)
+        return suggestion
     except Exception as e:
         print(f"❌ Error with OpenAI API: {e}")
         exit(1)
 
-def generate_commit_message(diff, temperature=0.3, history=None, change_type=None):
-    prompt = (
-        f"You are an assistant that generates commit messages in the conventional commits format.\n"
-        f"Based on the git diff below, generate a short, clear commit message in English.\n"
-        f"The ENTIRE message MUST be in LOWERCASE.\n"
-        f"Example: {change_type or 'feat'}: describe the change in lowercase.\n"
-        f"Only the message, with no extra explanations or remarks."
-    )
-    if change_type:
-        prompt = prompt.replace("{change_type or 'feat'}", change_type)
+def postprocess(suggestions, function):
+    """Applies `function` to a suggestion, or to each one of a multi-candidate result."""
+    if isinstance(suggestions, list):
+        return [function(suggestion) for suggestion in suggestions]
+    return function(suggestions)
 
+def build_user_prompt(diff, notes=(), history=None):
+    """Puts the diff first and the parts that change between requests last, so that
+    regenerations share the longest possible prefix with the previous request and
+    hit the provider's prompt cache.
+    """
+    prompt = f"Diff:\n{diff}"
+    for note in notes:
+        prompt += f"\n\n{note}"
     if history:
         prompt += "\n\nCrucially, provide a different and unique suggestion from the ones I have already rejected:\n- " + "\n- ".join(history)
+    return prompt
 
-    prompt += f"\n\nDiff:\n{diff}"
-    return get_openai_suggestion(prompt, temperature=temperature).lower()
+COMMIT_MESSAGE_PROMPT = (
+    "You are an assistant that generates commit messages in the conventional commits format.\n"
+    "Based on the git diff below, generate a short, clear commit message in English.\n"
+    "The ENTIRE message MUST be in LOWERCASE.\n"
+    "Example: feat: describe the change in lowercase.\n"
+    "Only the message, with no extra explanations or remarks."
+)
 
-def generate_pr_title(diff, temperature=0.4, history=None, **kwargs):
-    prompt = (
-        "You are an assistant that generates Pull Request titles in the conventional commits format.\n"
-        "Based on the TOTAL git diff of a branch below, generate a comprehensive and concise PR title in English.\n"
-        "Use a lowercase type prefix (e.g., 'feat:').\n"
-        "The description after the type MUST start with a capital letter.\n"
-        "Example: feat: Add user authentication and profile management.\n"
-        "Generate ONLY the title, with no extra explanations or remarks."
-    )
-    if history:
-        prompt += "\n\nCrucially, provide a different and unique suggestion from the ones I have already rejected:\n- " + "\n- ".join(history)
+def generate_commit_message(diff, temperature=0.3, history=None, change_type=None, stream=False, n=1, model="gpt-4o-mini"):
+    notes = [f"The type MUST be '{change_type}'. Example: {change_type}: describe the change in lowercase."] if change_type else []
+    prompt = build_user_prompt(diff, notes, history)
+    suggestions = get_openai_suggestion(prompt, model=model, temperature=temperature, stream=stream, transform=str.lower, n=n,
+                                        cache=not history, system=COMMIT_MESSAGE_PROMPT, operation="commit",
+                                        regenerate=len(history or []))
+    return postprocess(suggestions, str.lower)
 
-    prompt += f"\n\nDiff:\n{diff}"
-    suggestion = get_openai_suggestion(prompt, temperature=temperature)
-    
+def format_pr_title(suggestion):
     parts = suggestion.split(':', 1)
     if len(parts) == 2:
         pr_type = parts[0].strip().lower()
@@ -90,9 +1205,25 @@ def generate_pr_title(diff, temperature=0.4, history=None, **kwargs):
         return f"{pr_type}: {pr_desc.capitalize()}"
     return suggestion
 
-def generate_pr_body(diff, change_type, temperature=0.5):
+PR_TITLE_PROMPT = (
+    "You are an assistant that generates Pull Request titles in the conventional commits format.\n"
+    "Based on the TOTAL git diff of a branch below, generate a comprehensive and concise PR title in English.\n"
+    "Use a lowercase type prefix (e.g., 'feat:').\n"
+    "The description after the type MUST start with a capital letter.\n"
+    "Example: feat: Add user authentication and profile management.\n"
+    "Generate ONLY the title, with no extra explanations or remarks."
+)
+
+def generate_pr_title(diff, temperature=0.4, history=None, stream=False, n=1, **kwargs):
+    prompt = build_user_prompt(diff, history=history)
+    suggestions = get_openai_suggestion(prompt, temperature=temperature, stream=stream, transform=format_pr_title, n=n,
+                                        cache=not history, system=PR_TITLE_PROMPT, operation="title",
+                                        regenerate=len(history or []))
+    return postprocess(suggestions, format_pr_title)
+
+def pr_body_prompt(diff, change_type):
     pr_section_title = "Feature" if change_type == 'feat' else "Correção"
-    prompt = f"""**Sua Tarefa:**
+    return f"""**Sua Tarefa:**
 Você é um Engenheiro de Software Sênior e sua tarefa é gerar uma descrição de Pull Request (PR) completa, técnica e profissional em formato Markdown.
 
 **Instruções:**
@@ -125,107 +1256,478 @@ Você é um Engenheiro de Software Sênior e sua tarefa é gerar uma descrição
 ## Impacto Esperado
 (Descreva o resultado esperado após a implementação. Como a solução resolve o problema e qual o comportamento esperado em produção?)
 """
-    return get_openai_suggestion(prompt, model="gpt-4o-mini", temperature=temperature)
 
-def generate_branch_name(diff, temperature=0.5, history=None, change_type=None):
+def generate_pr_body(diff, change_type, temperature=0.5, stream=False):
+    prompt = pr_body_prompt(diff, change_type)
+    return get_openai_suggestion(prompt, model="gpt-4o-mini", temperature=temperature, stream=stream, operation="body")
+
+def generate_pr_content(diff, change_type, temperature=0.4):
+    """Asks for the PR title and body in a single JSON response.
+
+    Returns (title, body), or None when the answer can't be used and the caller
+    should fall back to separate requests.
+    """
     prompt = (
-        "You are an assistant that generates Git branch names.\n"
-        "Based on the git diff below, generate a short and descriptive branch name in English.\n"
-        "The branch name MUST follow the format: type/short-description-in-kebab-case.\n"
+        'Answer ONLY with a JSON object with two string fields, "title" and "body".\n\n'
+        f'"title":\n{PR_TITLE_PROMPT}\n\n'
+        '"body": the Pull Request description described below.\n\n'
+        + pr_body_prompt(diff, change_type)
     )
-    if change_type:
-        prompt += f"The type MUST be '{change_type}'.\n"
-        prompt += f"Example: {change_type}/add-user-authentication.\n"
-    else:
-        prompt += "Infer the type from the diff. Use one of the following types: 'feat', 'fix', 'chore', 'docs', 'refactor', 'style', 'test'.\n"
-        prompt += "Example: feat/add-user-authentication.\n"
+    content = get_openai_suggestion(prompt, temperature=temperature, response_format={"type": "json_object"},
+                                    operation="title+body")
+    try:
+        parsed = json.loads(content)
+    except ValueError:
+        return None
+    if not isinstance(parsed, dict):
+        return None
+    title, body = parsed.get("title"), parsed.get("body")
+    if not isinstance(title, str) or not isinstance(body, str) or not title.strip() or not body.strip():
+        return None
+    return format_pr_title(title.strip()), body.strip()
 
-    prompt += "Generate ONLY the branch name, with no extra explanations or remarks."
+BRANCH_NAME_PROMPT = (
+    "You are an assistant that generates Git branch names.\n"
+    "Based on the git diff below, generate a short and descriptive branch name in English.\n"
+    "The branch name MUST follow the format: type/short-description-in-kebab-case.\n"
+    "Unless a type is required after the diff, infer the type from the diff. Use one of the following types: 'feat', 'fix', 'chore', 'docs', 'refactor', 'style', 'test'.\n"
+    "Example: feat/add-user-authentication.\n"
+    "Generate ONLY the branch name, with no extra explanations or remarks."
+)
 
-    if history:
-        prompt += "\n\nCrucially, provide a different and unique suggestion from the ones I have already rejected:\n- " + "\n- ".join(history)
+def generate_branch_name(diff, temperature=0.5, history=None, change_type=None, stream=False, n=1):
+    notes = [f"The type MUST be '{change_type}'. Example: {change_type}/add-user-authentication."] if change_type else []
+    prompt = build_user_prompt(diff, notes, history)
+    suggestions = get_openai_suggestion(prompt, temperature=temperature, stream=stream, n=n,
+                                        cache=not history, system=BRANCH_NAME_PROMPT, operation="branch",
+                                        regenerate=len(history or []))
+    return postprocess(suggestions, str.strip)
+
+FILE_SUMMARY_PROMPT = (
+    "You are an assistant that summarizes part of a Pull Request diff.\n"
+    "Based on the git diff below, describe what changed and why it matters in at most five short bullet points in English.\n"
+    "Mention the functions, classes or settings involved.\n"
+    "Generate ONLY the bullet points, with no extra explanations or remarks."
+)
+
+def generate_file_summary(chunk, temperature=0.2):
+    return get_openai_suggestion(build_user_prompt(chunk), temperature=temperature, system=FILE_SUMMARY_PROMPT,
+                                 operation="file summary")
+
+def changed_files(revision, excludes, check=True):
+    """Lists the files changed by `revision` from `git diff --raw`, without reading their content.
+
+    Returns [{"path", "old_path", "old", "new", "status"}] with full blob ids.
+    """
+    output = run_git_command(["git", "diff", *revision, "--raw", "-z", "--no-abbrev", "--", ":/", *excludes], check=check)
+    fields = output.split("\0")
+    entries = []
+    i = 0
+    while i < len(fields):
+        if not fields[i].startswith(":"):
+            i += 1
+            continue
+        _, _, old, new, status = fields[i][1:].split()
+        if status[0] in "RC":
+            old_path, path = fields[i + 1], fields[i + 2]
+            i += 3
+        else:
+            old_path = path = fields[i + 1]
+            i += 2
+        entries.append({"path": path, "old_path": old_path, "old": old, "new": new, "status": status})
+    return entries
+
+@profiled("map-reduce")
+def summarize_branch_diff(base_branch):
+    """Map-reduce mode for big PR diffs: summarizes every changed file concurrently and
+    returns the summaries, which stand in for the diff in the title and body prompts.
+
+    Summaries are cached per (path, old blob, new blob), so a repeat run on the
+    same branch only reads and summarizes the files whose blobs changed.
+    Concurrency, per-file token cap and total wall time come from
+    GCPAI_MAP_CONCURRENCY (4), GCPAI_MAP_CHUNK_TOKENS (4000) and GCPAI_MAP_TIMEOUT (60s).
+    Files that don't finish in time are listed with their line counts only; once the
+    time is up, the workers stop picking up files, so no further requests are sent.
+    """
+    import queue
+
+    revision = branch_revision(base_branch)
+    pathspecs = excluded_pathspecs()
+    excludes = [spec.replace(":(top,", ":(top,exclude,", 1) for spec in pathspecs]
+    entries = changed_files(revision, excludes, check=False)
+    stats = excluded_file_stats(revision, pathspecs, check=False)
+    if not entries:
+        return stats
+
+    concurrency = max(1, int(env_number("GCPAI_MAP_CONCURRENCY", 4)))
+    chunk_tokens = int(env_number("GCPAI_MAP_CHUNK_TOKENS", 4000))
+    timeout = env_number("GCPAI_MAP_TIMEOUT", 60)
+
+    sections = {}
+    keys = {}
+    for entry in entries:
+        keys[entry["path"]] = ResponseCache.key(entry["path"], entry["old"], entry["new"], chunk_tokens)
+        if summary_cache.enabled:
+            cached = summary_cache.get(keys[entry["path"]])
+            if cached is not None:
+                sections[entry["path"]] = cached
+    pending = [entry for entry in entries if entry["path"] not in sections]
+
+    files = []
+    if pending:
+        # One `git diff` for the whole branch; files with a cached summary are dropped
+        # as they stream past instead of being listed on the command line.
+        paths = None if len(pending) == len(entries) else {entry["path"] for entry in pending}
+        diff, _ = read_git_diff(["git", "-c", "core.quotePath=false", "diff", *revision, "--", ":/", *excludes], check=False,
+                                max_file_chars=chunk_tokens * 8, paths=paths)
+        files = parse_diff(diff)
+
+    for file in files:
+        _collapse_metadata_only(file)
+        if _header_value(file, "deleted file mode") is not None:
+            file["header"], file["hunks"] = [f"deleted: {file['path']} (-{file['removed']} lines)"], []
+        if not file["hunks"]:
+            # Renames, mode changes, binaries and deletions are already one line.
+            sections[file["path"]] = render_file(file)
+            if summary_cache.enabled and file["path"] in keys:
+                summary_cache.put(keys[file["path"]], sections[file["path"]])
+    files = [file for file in files if file["hunks"]]
+    work = queue.Queue()
+    for file in files:
+        work.put(file)
+    stop = threading.Event()
+    summaries = {}
+
+    def summarize():
+        # Daemon workers, so a request that outlives the deadline never delays exit.
+        while not stop.is_set():
+            try:
+                file = work.get_nowait()
+            except queue.Empty:
+                return
+            chunk = render_file(file)
+            if count_tokens(chunk) > chunk_tokens:
+                chunk = render_file(_truncate_file(file, chunk_tokens))
+            try:
+                summary = generate_file_summary(chunk)
+            except SystemExit:
+                # The request path reports an API error and exits; on this thread that
+                # only ends the request, so the worker moves on to the next file.
+                continue
+            section = f"### {file['path']} (+{file['added']} -{file['removed']})\n{summary}"
+            # Cached as soon as it arrives: a summary that lands after the deadline
+            # was still paid for and is reused by the next run.
+            summaries[file["path"]] = section
+            if summary_cache.enabled and file["path"] in keys:
+                summary_cache.put(keys[file["path"]], section)
+
+    if files:
+        print(f"🗺️ Summarizing {len(files)} file(s), {concurrency} at a time ({len(entries) - len(pending)} reused from cache)...")
+    start = time.perf_counter()
+    workers = [threading.Thread(target=summarize, daemon=True) for _ in range(min(concurrency, len(files)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(max(0, start + timeout - time.perf_counter()))
+    stop.set()
+    elapsed = time.perf_counter() - start
+
+    missing = 0
+    for file in files:
+        section = summaries.get(file["path"])
+        if section is None:
+            missing += 1
+            section = f"### {file['path']} (+{file['added']} -{file['removed']})\n(summary unavailable)"
+        sections[file["path"]] = section
+
+    if files:
+        report = f"🗺️ Summarized {len(files) - missing}/{len(files)} file(s) in {elapsed:.1f}s"
+        if missing:
+            report += f"; {missing} timed out or failed and are listed by size only"
+        print(report + ".")
+    ordered = [stats] if stats else []
+    ordered += [sections[entry["path"]] for entry in entries if entry["path"] in sections]
+    # A path that didn't match its `--raw` entry still keeps its summary.
+    ordered += [section for path, section in sections.items() if path not in keys]
+    return "Per-file summaries of the branch changes:\n\n" + "\n\n".join(ordered)
+
+def speculate(generation_function, diff, cost, **kwargs):
+    """Generates a candidate in the background, returning it with the tokens it cost.
+
+    `cost["prompt_tokens"]` is updated with the size of the prompt once it is built.
+    """
+    _local.usage = []
+    _local.speculation = cost
+    try:
+        return generation_function(diff, stream=False, **kwargs), sum(_local.usage)
+    finally:
+        _local.usage = None
+        _local.speculation = None
+
+def start_speculation(generation_function, diff, **kwargs):
+    metrics["speculative_in_flight"] += 1
+    # Until the request is built, the diff is the best guess at its prompt size.
+    cost = {"prompt_tokens": count_tokens(diff)}
+    future = run_in_background(speculate, generation_function, diff, cost, **kwargs)
+    future.cost = cost
+    future.add_done_callback(lambda _: metrics.__setitem__("speculative_in_flight", metrics["speculative_in_flight"] - 1))
+    return future
+
+def discard_speculation(future):
+    if future is None:
+        return
+    metrics["speculative_discarded"] += 1
+    # A request still in flight usually outlives the run, so its prompt is counted
+    # now and corrected to the real usage if it finishes before exit.
+    estimate = 0 if future.done() else future.cost["prompt_tokens"]
+    metrics["speculative_discarded_tokens"] += estimate
+
+    def count_tokens(done):
+        if not done.cancelled() and done.exception() is None:
+            metrics["speculative_discarded_tokens"] += done.result()[1] - estimate
 
-    prompt += f"\n\nDiff:\n{diff}"
-    
-    suggestion = get_openai_suggestion(prompt, temperature=temperature)
-    return suggestion.strip()
+    future.add_done_callback(count_tokens)
 
-def user_interaction_loop(prompt_question, generation_function, diff, **kwargs):
+def print_metrics():
+    if metrics["staged_files"] or metrics["staging_seconds"] >= 1:
+        print(f"📊 Staging: {metrics['staged_files']} path(s) in {metrics['staging_seconds'] * 1000:.0f} ms.")
+    if metrics["cache_hits"] + metrics["cache_misses"]:
+        print(f"📊 Response cache: {metrics['cache_hits']} hit(s), {metrics['cache_misses']} miss(es).")
+    if metrics["summary_cache_hits"]:
+        print(f"📊 Summary cache: {metrics['summary_cache_hits']} file(s) reused, {metrics['summary_cache_misses']} summarized.")
+    used, discarded = metrics["speculative_used"], metrics["speculative_discarded"]
+    if not used and not discarded:
+        return
+    summary = f"📊 Speculative candidates: {used} used, {discarded} discarded ({metrics['speculative_discarded_tokens']} tokens wasted"
+    if metrics["speculative_in_flight"]:
+        summary += f", counting the prompts of {metrics['speculative_in_flight']} request(s) still in flight"
+    print(summary + ").")
+
+def user_interaction_loop(prompt_question, generation_function, diff, stream=False, speculative=False, candidates=1, initial=None, **kwargs):
     suggested_temperature = 0.5 if "branch" in prompt_question.lower() else 0.3
     previous_suggestions = []
+    next_candidate = None
+    if candidates > 1:
+        kwargs["n"] = candidates
+
+    def take_batch(result):
+        batch = result if isinstance(result, list) else [result]
+        unique = []
+        for candidate in batch:
+            if candidate and candidate not in unique and candidate not in previous_suggestions:
+                unique.append(candidate)
+        return unique or batch[:1]
+
+    # Candidates from the last multi-choice request that haven't been shown yet.
+    # `initial` is a suggestion (or a Future for one) obtained some other way,
+    # shown before any request is made.
+    if hasattr(initial, "result"):
+        initial = initial.result()
+    local_batch = take_batch(initial) if initial else []
+
     while True:
-        suggestion = generation_function(
-            diff,
-            temperature=suggested_temperature,
-            history=previous_suggestions,
-            **kwargs
-        )
-        print(f"\n{prompt_question}:\n{suggestion}")
+        if abandoned.is_set():
+            discard_speculation(next_candidate)
+            return None
+        if local_batch:
+            suggestion = local_batch.pop(0)
+            print(f"\n{prompt_question}:\n{suggestion}")
+        elif next_candidate:
+            local_batch = take_batch(next_candidate.result()[0])
+            suggestion = local_batch.pop(0)
+            next_candidate = None
+            metrics["speculative_used"] += 1
+            print(f"\n{prompt_question}:\n{suggestion}")
+        else:
+            streamed = stream and candidates == 1
+            if streamed:
+                print(f"\n{prompt_question}:")
+            local_batch = take_batch(generation_function(
+                diff,
+                temperature=suggested_temperature,
+                history=previous_suggestions,
+                stream=streamed,
+                **kwargs
+            ))
+            suggestion = local_batch.pop(0)
+            if not streamed:
+                print(f"\n{prompt_question}:\n{suggestion}")
 
-        response = input("    ➡️ Accept? (Y) | 🔄 Regenerate? (r) | 🚫 Cancel? (n): ").strip().lower()
+        if settings["non_interactive"]:
+            return suggestion
+
+        if speculative and not local_batch and not next_candidate:
+            # Prepare what a regenerate would ask for while the user reads this one.
+            next_candidate = start_speculation(
+                generation_function,
+                diff,
+                temperature=min(1.0, suggested_temperature + 0.2),
+                history=previous_suggestions + ([suggestion] if suggestion else []),
+                **kwargs
+            )
+
+        if abandoned.is_set():
+            discard_speculation(next_candidate)
+            return None
+        with Span("user: review", wait=True):
+            response = input("    ➡️ Accept? (Y) | 🔄 Regenerate? (r) | 🚫 Cancel? (n): ").strip().lower()
 
         if response in ('y', ''):
+            discard_speculation(next_candidate)
             return suggestion
         elif response == "r":
             if suggestion:
                 previous_suggestions.append(suggestion)
-            suggested_temperature = min(1.0, suggested_temperature + 0.2)
-            print("🔄 Regenerating...")
+            if not local_batch:
+                suggested_temperature = min(1.0, suggested_temperature + 0.2)
+                print("🔄 Regenerating...")
             continue
         else:
+            discard_speculation(next_candidate)
             return None
 
-def create_pull_request(change_type=None):
+def derive_branch_name(commit_message, max_length=50):
+    """Builds a branch name from a conventional commit message without calling the API.
+
+    `feat(api): add user login` becomes `feat/add-user-login`, cut at a word
+    boundary to `max_length` and suffixed with -2, -3... if the branch exists.
+    Names that would clash with an existing branch as a directory or a file
+    (`feat` vs `feat/...`) are changed the same way.
+    """
+    subject = commit_message.strip().splitlines()[0].lower()
+    prefix, separator, description = subject.partition(":")
+    branch_type = re.sub(r"\(.*\)|!", "", prefix).strip()
+    if not separator or not re.fullmatch(r"[a-z]+", branch_type):
+        branch_type, description = "feat", subject
+    slug = re.sub(r"[^a-z0-9]+", "-", description).strip("-") or "update"
+    limit = max_length - len(branch_type) - 1
+    if len(slug) > limit:
+        slug = slug[:limit + 1].rsplit("-", 1)[0] if "-" in slug[:limit + 1] else slug[:limit]
+    name = f"{branch_type}/{slug}"
+
+    # Refs are files, so `feat` and `feat/x` can't both exist.
+    existing = [ref[len("refs/heads/"):] for ref in git.refs("refs/heads/")]
+    if any(name.startswith(branch + "/") for branch in existing):
+        name = f"{branch_type}-{slug}"
+
+    def taken(candidate):
+        return any(branch == candidate or branch.startswith(candidate + "/")
+                   or candidate.startswith(branch + "/") for branch in existing)
+
+    candidate, suffix = name, 2
+    while taken(candidate):
+        candidate = f"{name}-{suffix}"
+        suffix += 1
+    return candidate
+
+def choose_branch(diff, change_type, original_branch_name, initial=None, **loop_options):
+    """Runs the branch-name loop and switches to the accepted branch; returns whether one was created."""
+    branch_name = user_interaction_loop("Suggested branch name", generate_branch_name, diff, change_type=change_type, initial=initial, **loop_options)
+    if branch_name and settings["dry_run"]:
+        print(f"🧪 Dry run: not switching to '{branch_name}'.")
+    elif branch_name and branch_name != original_branch_name:
+        # Exits when git refuses the name, before anything is committed on the wrong branch.
+        run_git_command(["git", "checkout", "-b", branch_name])
+        outcome["branch"] = branch_name
+        print(f"✅ Switched to '{branch_name}'.")
+        return True
+    elif not branch_name:
+        print("🚫 Branch creation canceled.")
+    if branch_name:
+        outcome["branch"] = branch_name
+    return False
+
+def github_cli_available():
     try:
-        run_git_command(['gh', '--version'], check=True)
+        subprocess.run(['gh', '--version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        return True
     except (subprocess.CalledProcessError, FileNotFoundError):
         print("❌ GitHub CLI (gh) not found or not configured correctly.")
-        return
+        return False
 
-    default_branch = ""
+@profiled("default branch")
+def find_default_branch():
+    """Finds the remote's default branch, preferring local answers over the network.
+
+    Order: the value cached in `gcpai.defaultBranch` (valid for
+    GCPAI_DEFAULT_BRANCH_TTL hours, default 24), `refs/remotes/origin/HEAD`,
+    `git ls-remote --symref origin HEAD`, and finally a local origin/main or
+    origin/master. Whatever is found is cached in the repository config.
+    """
+    cached = {}
+    for line in run_git_command(["git", "config", "--get-regexp", r"^gcpai\.defaultbranch"], check=False).splitlines():
+        key, _, value = line.partition(" ")
+        cached[key] = value
     try:
-        head_branch_output = run_git_command(["git", "remote", "show", "origin"])
-        for line in head_branch_output.splitlines():
-            if 'HEAD branch' in line:
-                default_branch = line.split(':')[1].strip()
+        age = time.time() - float(cached.get("gcpai.defaultbranchcheckedat", 0))
+    except ValueError:
+        age = float("inf")
+    if cached.get("gcpai.defaultbranch") and age < env_number("GCPAI_DEFAULT_BRANCH_TTL", 24) * 3600:
+        return cached["gcpai.defaultbranch"]
+
+    default_branch = ""
+    origin_head = run_git_command(["git", "symbolic-ref", "--quiet", "--short", "refs/remotes/origin/HEAD"], check=False)
+    if origin_head.startswith("origin/"):
+        default_branch = origin_head[len("origin/"):]
+
+    if not default_branch:
+        for line in run_git_command(["git", "ls-remote", "--symref", "origin", "HEAD"], check=False).splitlines():
+            if line.startswith("ref: refs/heads/"):
+                default_branch = line[len("ref: refs/heads/"):].split("\t", 1)[0]
                 break
-    except (subprocess.CalledProcessError, IndexError):
-        pass
 
     if not default_branch:
+        remote_refs = git.refs("refs/remotes/origin/")
         for branch in ["main", "master"]:
-            try:
-                run_git_command(["git", "show-ref", "--verify", f"refs/remotes/origin/{branch}"])
+            if f"refs/remotes/origin/{branch}" in remote_refs:
                 default_branch = branch
                 break
-            except subprocess.CalledProcessError:
-                continue
-    
+
     if not default_branch:
         print("❌ Could not determine the default branch. Please create the PR manually.")
-        return
+        return default_branch
+    run_git_command(["git", "config", "gcpai.defaultBranch", default_branch], check=False)
+    run_git_command(["git", "config", "gcpai.defaultBranchCheckedAt", str(int(time.time()))], check=False)
+    return default_branch
 
-    full_diff = get_git_diff(staged=False, base_branch=default_branch)
+def prepare_pull_request(change_type, default_branch, **loop_options):
+    """Generates the PR title and body against `default_branch`; returns (title, body) or None."""
+    if settings["map_reduce"]:
+        full_diff = summarize_branch_diff(default_branch)
+    else:
+        full_diff = prepare_diff(get_git_diff(staged=False, base_branch=default_branch))
 
     if not full_diff:
         print("✅ No differences found to create a PR.")
-        return
+        outcome["status"] = "nothing"
+        return None
 
+    if abandoned.is_set():
+        return None
     if not change_type:
-        change_type = inquirer.select(
-            message="Select the type of change for the PR:",
-            choices=[
-                Choice(value="feat", name="feat - A new feature"),
-                Choice(value="fix", name="fix - A bug fix"),
+        change_type = select_option(
+            "Select the type of change for the PR:",
+            [
+                ("feat", "feat - A new feature"),
+                ("fix", "fix - A bug fix"),
             ],
             default="feat",
-            vi_mode=True,
-        ).execute()
+        )
+
+    combined = None
+    if settings["combined_pr"]:
+        print("🤖 Generating PR title and description...")
+        combined = generate_pr_content(full_diff, change_type)
+        if not combined:
+            print("⚠️ Could not parse the combined response; generating title and description separately.")
 
-    pr_title = user_interaction_loop("Suggested PR Title", generate_pr_title, full_diff)
+    pr_title = user_interaction_loop("Suggested PR Title", generate_pr_title, full_diff, initial=combined and combined[0], **loop_options)
+    if abandoned.is_set():
+        return None
     if not pr_title:
         print("🚫 PR title generation canceled.")
-        return
+        outcome["status"] = "canceled"
+        return None
 
     # Extract change type from the final PR title to ensure consistency
     body_change_type = change_type
@@ -234,79 +1736,335 @@ def create_pull_request(change_type=None):
         if title_prefix in ['feat', 'fix']:
             body_change_type = title_prefix
 
-    print("🤖 Generating PR description...")
-    pr_body = generate_pr_body(full_diff, body_change_type)
+    # The combined body describes the same diff, so it still fits a regenerated
+    # title; only a change of type calls for a new description.
+    if combined and body_change_type == change_type:
+        pr_body = combined[1]
+    elif abandoned.is_set():
+        return None
+    else:
+        print("🤖 Generating PR description...")
+        pr_body = generate_pr_body(full_diff, body_change_type, stream=loop_options.get("stream", False))
+    return pr_title, pr_body
 
+def submit_pull_request(pr_title, pr_body):
+    outcome["pull_request"] = {"title": pr_title, "body": pr_body, "url": None}
+    if settings["dry_run"]:
+        print(f"🧪 Dry run: not creating the PR.\n\n{pr_title}\n\n{pr_body}")
+        return
     print("🚀 Creating PR...")
     pr_command = ['gh', 'pr', 'create', '--title', pr_title, '--body', pr_body]
-    pr_output = run_git_command(pr_command, check=True)
+    with Span("gh pr create") as span:
+        span["bytes_in"] = len(pr_title) + len(pr_body)
+        pr_output = run_git_command(pr_command, check=True)
+    outcome["pull_request"]["url"] = pr_output
     print(f"✅ PR created: {pr_output}")
 
+def create_pull_request(change_type=None, **loop_options):
+    if not settings["dry_run"] and not github_cli_available():
+        outcome["status"] = "failed"
+        return
+    default_branch = find_default_branch()
+    if not default_branch:
+        outcome["status"] = "failed"
+        return
+    pull_request = prepare_pull_request(change_type, default_branch, **loop_options)
+    if pull_request:
+        submit_pull_request(*pull_request)
+
+async def push_branch(branch):
+    import asyncio
+    command = ["git", "push", "--set-upstream", "origin", branch]
+    with Span("git push"):
+        process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        _, stderr = await process.communicate()
+    git.invalidate("push")
+    if process.returncode:
+        print(f"❌ Error executing: {' '.join(command)}")
+        print(f"  {stderr.decode('utf-8', 'replace').strip()}")
+        return False
+    return True
+
+async def _push_and_create_pull_request(branch, change_type, loop_options):
+    import asyncio
+    push = asyncio.create_task(push_branch(branch))
+    # Everything the PR needs runs while the push is in flight, on daemon threads
+    # so a pending prompt never blocks exit; only `gh pr create` waits for the push.
+    gh_available, default_branch = await asyncio.gather(
+        asyncio.wrap_future(run_in_background(github_cli_available)),
+        asyncio.wrap_future(run_in_background(find_default_branch)),
+    )
+    preparation = None
+    if gh_available and default_branch:
+        preparation = asyncio.wrap_future(
+            run_in_background(prepare_pull_request, change_type, default_branch, **loop_options)
+        )
+        # Watch the push while the PR is prepared, so a failed push stops the
+        # preparation instead of waiting for its prompts and requests.
+        await asyncio.wait([push, preparation], return_when=asyncio.FIRST_COMPLETED)
+    else:
+        outcome["status"] = "failed"
+    if not await push:
+        abandoned.set()
+        if preparation and not preparation.done():
+            print("🚫 Push failed; abandoning the PR.")
+        exit(1)
+    pull_request = await preparation if preparation else None
+    outcome["pushed"] = True
+    print("✅ Pushed successfully.")
+    if pull_request:
+        submit_pull_request(*pull_request)
+
+def push_and_create_pull_request(branch, change_type=None, **loop_options):
+    """Pushes `branch` and prepares the PR concurrently, joining before `gh pr create`."""
+    import asyncio
+    print(f"🚀 Pushing to '{branch}'...")
+    asyncio.run(_push_and_create_pull_request(branch, change_type, loop_options))
+
+def print_outcome(stream):
+    """Writes `outcome` as one JSON object to `stream`, the real stdout under --json."""
+    if outcome["status"] is None:
+        outcome["status"] = "failed"
+    stream.write(json.dumps({**outcome, "exit_code": EXIT_CODES[outcome["status"]]}, ensure_ascii=False) + "\n")
+    stream.flush()
+
+HOOK_MARKER = "# Installed by gcpai"
+# Commit message sources for which git already has a message; the hook leaves them alone.
+HOOK_SKIPPED_SOURCES = {"message", "template", "merge", "squash", "commit"}
+
+def hook_path():
+    return os.path.abspath(run_git_command(["git", "rev-parse", "--git-path", "hooks/prepare-commit-msg"]))
+
+def install_hook(force=False):
+    path = hook_path()
+    if os.path.exists(path) and not force:
+        with open(path, encoding="utf-8", errors="replace") as file:
+            if HOOK_MARKER not in file.read():
+                print(f"❌ {path} already exists. Use --force to replace it.")
+                exit(1)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(
+            "#!/bin/sh\n"
+            f"{HOOK_MARKER}: suggests a commit message. It never fails, so it never blocks a commit.\n"
+            f'"{sys.executable}" "{os.path.abspath(__file__)}" hook prepare-commit-msg "$@" </dev/null >/dev/null 2>&1\n'
+            "exit 0\n"
+        )
+    os.chmod(path, 0o755)
+    print(f"✅ Installed the prepare-commit-msg hook at {path}.")
+
+def uninstall_hook():
+    path = hook_path()
+    if not os.path.exists(path):
+        print("ℹ️ No prepare-commit-msg hook installed.")
+        return
+    with open(path, encoding="utf-8", errors="replace") as file:
+        if HOOK_MARKER not in file.read():
+            print(f"❌ {path} wasn't installed by gcpai; leaving it alone.")
+            exit(1)
+    os.remove(path)
+    print("✅ Removed the prepare-commit-msg hook.")
+
+def prepare_commit_msg(message_file, source=None):
+    """prepare-commit-msg hook: writes a suggested message above git's template.
+
+    Gives up silently, leaving the template as it is, when git already has a
+    message, nothing is staged or the answer takes longer than GCPAI_HOOK_TIMEOUT
+    seconds (1.5). The diff is compacted to GCPAI_HOOK_TOKEN_BUDGET tokens (3000),
+    the model is GCPAI_HOOK_MODEL (gpt-4o-mini), and the response cache answers
+    repeated attempts at the same commit instantly.
+    """
+    deadline = _started + env_number("GCPAI_HOOK_TIMEOUT", 1.5)
+    if source in HOOK_SKIPPED_SOURCES or not os.getenv("OPENAI_API_KEY"):
+        return
+    with open(message_file, encoding="utf-8") as file:
+        template = file.read()
+    # With commit.verbose the diff follows a scissors line; only what's above it counts.
+    above_scissors = template.split("# ------------------------ >8", 1)[0]
+    if any(line.strip() and not line.startswith("#") for line in above_scissors.splitlines()):
+        return
+
+    settings["non_interactive"] = True
+    settings["token_budget"] = int(env_number("GCPAI_HOOK_TOKEN_BUDGET", 3000))
+    # Importing openai takes a good part of the budget; do it while git computes the diff.
+    run_in_background(get_client)
+    diff = prepare_diff(get_git_diff(staged=True))
+    if not diff:
+        return
+    model = os.getenv("GCPAI_HOOK_MODEL", "gpt-4o-mini")
+    suggestion = run_in_background(generate_commit_message, diff, model=model)
+    try:
+        message = suggestion.result(timeout=max(0, deadline - time.perf_counter()))
+    except Exception:
+        return
+    if message:
+        with open(message_file, "w", encoding="utf-8") as file:
+            file.write(message + "\n" + template)
+
+def run_hook(argv):
+    """`gcpai hook install|uninstall|prepare-commit-msg`."""
+    parser = argparse.ArgumentParser(prog="gcpai hook", description="Suggests commit messages from a git hook.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    install = commands.add_parser("install", help="Install the prepare-commit-msg hook in this repository.")
+    install.add_argument("--force", action="store_true", help="Replace an existing hook.")
+    commands.add_parser("uninstall", help="Remove the hook installed by gcpai.")
+    prepare = commands.add_parser("prepare-commit-msg", help="Hook entry point; called by git.")
+    prepare.add_argument("message_file")
+    prepare.add_argument("source", nargs="?")
+    prepare.add_argument("commit", nargs="?")
+    args = parser.parse_args(argv)
+
+    if args.command == "install":
+        install_hook(args.force)
+    elif args.command == "uninstall":
+        uninstall_hook()
+    else:
+        # A hook failure would abort the commit, so nothing may escape from here.
+        try:
+            prepare_commit_msg(args.message_file, args.source)
+        except BaseException:
+            pass
+        # Exit right away rather than wait at shutdown for a request that missed the deadline.
+        os._exit(0)
+
 def main():
+    if sys.argv[1:2] == ["stats"]:
+        print_stats(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["hook"]:
+        run_hook(sys.argv[2:])
+        return
     parser = argparse.ArgumentParser(description="Generates commits and branches with AI.")
     parser.add_argument("--branch", "-b", action="store_true", help="Request the generation of a branch name.")
     parser.add_argument("--pr", action="store_true", help="Create a pull request on GitHub.")
+    parser.add_argument("--derive-branch", action="store_true", help="With --branch, build the branch name from the accepted commit message instead of asking the AI.")
+    parser.add_argument("--stream", action="store_true", help="Show suggestions token by token as they are generated.")
+    parser.add_argument("--speculative", action="store_true", help="Pre-generate the next suggestion while you review the current one.")
+    parser.add_argument("--candidates", "-n", type=int, default=1, metavar="N", help="Request N suggestions per API call and page through them locally.")
+    parser.add_argument("--token-budget", type=int, metavar="TOKENS", help="Compact diffs to about this many tokens before prompting (default: GCPAI_TOKEN_BUDGET or 12000; 0 disables).")
+    parser.add_argument("--map-reduce", action="store_true", help="Summarize big PR diffs file by file in parallel and prompt with the summaries.")
+    parser.add_argument("--combined-pr", action="store_true", help="Generate the PR title and description in a single request.")
+    parser.add_argument("--usage", action="store_true", help="Print prompt, cached and completion token counts after each API call.")
+    parser.add_argument("--offline", action="store_true", help="Don't fetch; diff PRs against the local origin/<base> ref.")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the API instead of reusing cached responses.")
+    parser.add_argument("--profile", action="store_true", help="Print where the run spent its time when it ends.")
+    parser.add_argument("--profile-file", metavar="FILE", help="Append per-stage timings to FILE as JSON lines.")
+    parser.add_argument("--yes", "-y", "--non-interactive", dest="non_interactive", action="store_true",
+                        help="Never prompt: accept the first suggestion and the default choices.")
+    parser.add_argument("--type", choices=["auto", "feat", "fix"], help="Type of change, instead of asking (auto lets the AI decide).")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON on stdout; progress goes to stderr.")
+    parser.add_argument("--dry-run", action="store_true", help="Generate everything from the index as it is, without staging, switching branches, committing, pushing or opening the PR.")
+    parser.add_argument("--no-add", action="store_true", help="Use the index as it is instead of staging changes first.")
+    parser.add_argument("paths", nargs="*", metavar="PATHSPEC", help="Only stage changes under these paths (default: the current directory).")
     args = parser.parse_args()
+    response_cache.enabled = summary_cache.enabled = not args.no_cache
+    settings["token_budget"] = args.token_budget
+    settings["map_reduce"] = args.map_reduce
+    settings["combined_pr"] = args.combined_pr
+    settings["show_usage"] = args.usage
+    settings["offline"] = args.offline
+    settings["profile"] = args.profile
+    settings["profile_file"] = args.profile_file
+    settings["non_interactive"] = args.non_interactive
+    settings["dry_run"] = args.dry_run
+    if args.profile or args.profile_file:
+        atexit.register(print_profile)
+    if args.json:
+        atexit.register(print_outcome, sys.stdout)
+        sys.stdout = sys.stderr
+    loop_options = {"stream": args.stream, "speculative": args.speculative, "candidates": max(1, args.candidates)}
 
-    if not os.getenv("OPENAI_API_KEY"):
-        print("❌ OPENAI_API_KEY environment variable not set.")
-        exit(1)
-
-    run_git_command(["git", "add", "."])
-    staged_diff = get_git_diff(staged=True)
+    if not args.no_add and not args.dry_run:
+        # Checked before touching the index, so a missing key leaves nothing staged.
+        ensure_api_key()
+        stage_changes(args.paths or ["."])
+    staged_diff = prepare_diff(get_git_diff(staged=True))
 
     change_type = None
     if staged_diff:
-        change_type = inquirer.select(
-            message="Select the type of change:",
-            choices=[
-                Choice(value=None, name="auto - Let AI detect the type"),
-                Choice(value="feat", name="feat - A new feature"),
-                Choice(value="fix", name="fix - A bug fix"),
-            ],
-            default=None,
-            vi_mode=True,
-        ).execute()
+        ensure_api_key()
+        if args.type:
+            change_type = None if args.type == "auto" else args.type
+        else:
+            change_type = select_option(
+                "Select the type of change:",
+                [
+                    (None, "auto - Let AI detect the type"),
+                    ("feat", "feat - A new feature"),
+                    ("fix", "fix - A bug fix"),
+                ],
+            )
+        outcome["change_type"] = change_type
 
         # Branching and committing logic
-        original_branch_name = run_git_command(["git", "rev-parse", "--abbrev-ref", "HEAD"])
+        original_branch_name = git.current_branch()
         new_branch_created = False
-        if args.branch:
-            branch_name = user_interaction_loop("Suggested branch name", generate_branch_name, staged_diff, change_type=change_type)
-            if branch_name and branch_name != original_branch_name:
-                run_git_command(["git", "checkout", "-b", branch_name], check=False)
-                new_branch_created = True
-                print(f"✅ Switched to '{branch_name}'.")
-            elif not branch_name:
-                print("🚫 Branch creation canceled.")
-
-        commit_message = user_interaction_loop("Suggested commit message", generate_commit_message, staged_diff, change_type=change_type)
-
-        if commit_message:
-            print("💾 Committing...")
-            run_git_command(["git", "commit", "-m", commit_message])
-            branch_to_push = run_git_command(["git", "rev-parse", "--abbrev-ref", "HEAD"])
-            print(f"🚀 Pushing to '{branch_to_push}'...")
-            run_git_command(["git", "push", "--set-upstream", "origin", branch_to_push])
-            print("✅ Pushed successfully.")
+        commit_candidate = None
+        if args.branch and not args.derive_branch:
+            # The commit message doesn't depend on the branch name, so request it
+            # now and have it ready once the branch is settled.
+            commit_candidate = run_in_background(
+                generate_commit_message,
+                staged_diff,
+                history=[],
+                change_type=change_type,
+                **({"n": loop_options["candidates"]} if loop_options["candidates"] > 1 else {})
+            )
+            new_branch_created = choose_branch(staged_diff, change_type, original_branch_name, **loop_options)
+
+        commit_message = user_interaction_loop("Suggested commit message", generate_commit_message, staged_diff, change_type=change_type, initial=commit_candidate, **loop_options)
 
+        if commit_message and args.branch and args.derive_branch:
+            # Offer a branch name built from the accepted message; only a regenerate calls the API.
+            new_branch_created = choose_branch(staged_diff, change_type, original_branch_name,
+                                               initial=derive_branch_name(commit_message), **loop_options)
+
+        outcome["commit_message"] = commit_message
+        if commit_message and args.dry_run:
+            print("🧪 Dry run: not committing or pushing.")
+            outcome["branch"] = outcome["branch"] or git.current_branch()
+            if args.pr:
+                create_pull_request(change_type, **loop_options)
+        elif commit_message:
+            print("💾 Committing...")
+            with Span("git commit"):
+                run_git_command(["git", "commit", "-m", commit_message])
+            branch_to_push = git.current_branch()
+            outcome["branch"] = branch_to_push
             if args.pr:
-                create_pull_request(change_type)
+                push_and_create_pull_request(branch_to_push, change_type, **loop_options)
+            else:
+                print(f"🚀 Pushing to '{branch_to_push}'...")
+                with Span("git push"):
+                    run_git_command(["git", "push", "--set-upstream", "origin", branch_to_push])
+                outcome["pushed"] = True
+                print("✅ Pushed successfully.")
         else:
             print("🚫 Commit canceled.")
+            outcome["status"] = "canceled"
             if new_branch_created:
-                go_back = input(f"❓ Return to '{original_branch_name}'? (y/N): ").strip().lower()
+                with Span("user: review", wait=True):
+                    go_back = input(f"❓ Return to '{original_branch_name}'? (y/N): ").strip().lower()
                 if go_back == 'y':
                     run_git_command(["git", "checkout", original_branch_name])
     elif args.pr:
+        ensure_api_key()
         print("ℹ️ No staged changes. Creating PR from existing commits.")
-        create_pull_request()
+        outcome["branch"] = git.current_branch()
+        outcome["change_type"] = None if args.type in (None, "auto") else args.type
+        create_pull_request(outcome["change_type"], **loop_options)
     else:
         print("✅ No staged changes.")
+        outcome["status"] = "nothing"
+
+    print_metrics()
+    outcome["status"] = outcome["status"] or "ok"
+    exit(EXIT_CODES[outcome["status"]])
 
 if __name__ == "__main__":
     try:
         main()
     except KeyboardInterrupt:
         print("\n\n🚫 Operation canceled by user. Exiting.")
+        outcome["status"] = "interrupted"
         exit(130)